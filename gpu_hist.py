@@ -3,24 +3,1218 @@
 
 
 from collections import Iterable
+import functools
 import os
 import sys
+import threading
 import time
 
 import numpy as np
+try:
+    from psutil import virtual_memory
+except ImportError:
+    virtual_memory = None
 from pycuda.compiler import SourceModule
 import pycuda.driver as cuda
 import pycuda.autoinit
 
 
-__all__ = ['FTYPE', 'GPUHist', 'test_GPUHist']
+__all__ = ['FTYPE', 'SAMPLE_TYPES', 'OUT_OF_RANGE_MODES', 'AUTO_EDGES',
+           'MAX_FILL_AXES', 'EdgeSet', 'QuantileSketch', 'SummedAreaTable',
+           'Profile', 'ApproxHist', 'MemoryPlan', 'HistSpec',
+           'TRANSFORM_KINDS', 'Transform', 'Selection', 'FillPlan',
+           'RollingHist', 'DecayedHist', 'GPUHist', 'make_plan',
+           'test_GPUHist', 'test_concurrent_fills']
 
 
 # from pisa import FTYPE, C_FTYPE, C_PRECISION_DEF # Used in PISA
 FTYPE = np.float64
 
+# Sample types which can be histogrammed without converting the sample first
+# and the corresponding C type and SAMPLE_* kind of the kernels. Half
+# precision values are read as their bits and converted in the kernels.
+# uint64 values may not fit into the signed 64 bit integers used to bin
+# integers, so they are binned like floating point values.
+SAMPLE_TYPES = {
+    np.dtype(np.int8): ('signed char', 'SAMPLE_INTEGER'),
+    np.dtype(np.uint8): ('unsigned char', 'SAMPLE_INTEGER'),
+    np.dtype(np.int16): ('short int', 'SAMPLE_INTEGER'),
+    np.dtype(np.uint16): ('unsigned short int', 'SAMPLE_INTEGER'),
+    np.dtype(np.int32): ('int', 'SAMPLE_INTEGER'),
+    np.dtype(np.uint32): ('unsigned int', 'SAMPLE_INTEGER'),
+    np.dtype(np.int64): ('long long int', 'SAMPLE_INTEGER'),
+    np.dtype(np.uint64): ('unsigned long long int', 'SAMPLE_FLOAT'),
+    np.dtype(np.float16): ('unsigned short int', 'SAMPLE_HALF'),
+    np.dtype(np.float32): ('float', 'SAMPLE_FLOAT'),
+    np.dtype(np.float64): ('double', 'SAMPLE_FLOAT'),
+}
+
+# Values of `out_of_range` in `GPUHist.get_hist` and the corresponding
+# FLOW_* mode of the kernels
+OUT_OF_RANGE_MODES = {'drop': 0, 'clamp': 1, 'count': 0}
+
+# Values of `auto_edges` in `GPUHist.get_hist`
+AUTO_EDGES = ('linear', 'quantile')
+
+# Maximum number of distinct axes in `GPUHist.fill_many` (MAX_AXES of the
+# kernels)
+MAX_FILL_AXES = 64
+
+
+def _in_context(method):
+    """Decorator which makes the CUDA context of the histogrammer (`self` or
+    `self.histogrammer`) current while the method runs, so it can be called
+    from any thread"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        getattr(self, 'histogrammer', self).context.push()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            cuda.Context.pop()
+    return wrapper
+
+
+def _thread_local(name, doc):
+    """Attribute of a `GPUHist` which each thread sets and reads on its own"""
+    def get(self):
+        return getattr(self._local, name, None)
+    def set(self, value):
+        setattr(self._local, name, value)
+    return property(get, set, doc=doc)
+
+
+class EdgeSet(object):
+    """
+    Edges for all dimensions of a histogram together with everything derived
+    from them. `GPUHist` caches one instance per distinct set of edges, so
+    the derived quantities and device copies are computed only once.
+
+    Parameters
+    ----------
+    edges : sequence of arrays
+        Edges for each dimension, including the rightmost edge. Dimensions
+        may have different numbers of bins and non-uniform edges.
+    ftype : np.float64 or np.float32
+
+    """
+    # Upper limit for the number of cells of a guide table per dimension.
+    # Dimensions which would need more cells use a binary search instead.
+    max_guide_size = 1 << 16
+
+    def __init__(self, edges, ftype=FTYPE):
+        self.ftype = ftype
+        self.edges = [np.asarray(e, dtype=ftype).ravel() for e in edges]
+        for d, e in enumerate(self.edges):
+            if len(e) < 2:
+                raise ValueError('Dimension %d needs at least two edges' % d)
+            if np.any(np.diff(e) <= 0):
+                raise ValueError('Edges of dimension %d must increase '
+                                 'monotonically' % d)
+        self.n_dims = len(self.edges)
+        self.n_bins = tuple(len(e) - 1 for e in self.edges)
+        self.n_flat_bins = int(np.prod(self.n_bins))
+        self.n_edges = sum(len(e) for e in self.edges)
+        self.flat_edges = np.concatenate(self.edges)
+        self.widths = [np.diff(e) for e in self.edges]
+        self._volume = None
+        self._guides = None
+        self._int_range = None
+        self._device_arrays = None
+
+    @staticmethod
+    def key(edges):
+        """Key which identifies a set of edges in a cache"""
+        return tuple(np.asarray(e).tobytes() for e in edges)
+
+    @property
+    def volume(self):
+        """Volume of each bin as outer product of the widths"""
+        if self._volume is None:
+            volume = self.widths[0]
+            for widths in self.widths[1:]:
+                volume = np.multiply.outer(volume, widths)
+            self._volume = volume
+        return self._volume
+
+    def density(self, hist):
+        """Normalize `hist` such that its integral over all bins is one, as
+        `np.histogramdd(..., density=True)` does."""
+        return hist / (float(hist.sum()) * self.volume)
+
+    @property
+    def guides(self):
+        """Lookup structures for the binning kernels as a tuple
+        (guide tables, guide info, guide scales).
+
+        A guide table divides the range of one dimension into cells of equal
+        width which are not wider than its narrowest bin and stores the bin at
+        the start of each cell. Thus each value is binned with one
+        multiplication and a fix-up over at most one edge, whatever the
+        spacing of the edges. Uniform edges get a table with one cell per bin.
+        Dimensions which would need more than `max_guide_size` cells get a
+        table size of 0 and are binned with a binary search.
+
+        The guide info holds the offsets of all tables followed by their sizes.
+        """
+        if self._guides is None:
+            guides = []
+            offsets = []
+            sizes = []
+            scales = []
+            offset = 0
+            for edges in self.edges:
+                edges = edges.astype(np.float64)
+                n_bins = len(edges) - 1
+                span = edges[-1] - edges[0]
+                n_cells = span / np.min(np.diff(edges))
+                if n_cells > max(self.max_guide_size, n_bins):
+                    size = 0
+                    scale = 0
+                else:
+                    size = max(int(np.ceil(n_cells)), n_bins)
+                    scale = size / span
+                    starts = edges[0] + np.arange(size) * (span / size)
+                    guide = np.searchsorted(edges, starts, side='right') - 1
+                    guides.append(np.clip(guide, 0, n_bins-1))
+                offsets.append(offset)
+                sizes.append(size)
+                scales.append(scale)
+                offset += size
+            # Avoid empty arrays if no dimension uses a guide table
+            guides.append(np.zeros(1))
+            self._guides = (
+                np.concatenate(guides).astype(np.uint32),
+                np.asarray(offsets + sizes, dtype=np.uint32),
+                np.asarray(scales, dtype=self.ftype)
+            )
+        return self._guides
+
+    @property
+    def int_range(self):
+        """First and last integer within the edges of each dimension whose
+        bins have unit width. Integer samples are binned by subtracting the
+        first integer. Other dimensions get first > last."""
+        if self._int_range is None:
+            int_range = []
+            for edges in self.edges:
+                edges = edges.astype(np.float64)
+                if np.all(np.diff(edges) == 1):
+                    int_range += [np.ceil(edges[0]), np.floor(edges[-1])]
+                else:
+                    int_range += [1, 0]
+            self._int_range = np.asarray(int_range, dtype=np.int64)
+        return self._int_range
+
+    def to_device(self, itype):
+        """Return device arrays with the number of bins of each dimension, the
+        edges, the guide tables and the integer ranges in the order expected
+        by the `*_with_edges` kernels. They are only copied once; threads
+        which race here copy them twice and each keeps its copy alive."""
+        if self._device_arrays is None:
+            guides, guide_info, guide_scales = self.guides
+            self._device_arrays = (
+                cuda.to_device(np.asarray(self.n_bins, dtype=itype)),
+                cuda.to_device(self.flat_edges),
+                cuda.to_device(guides.astype(itype)),
+                cuda.to_device(guide_info.astype(itype)),
+                cuda.to_device(guide_scales),
+                cuda.to_device(self.int_range)
+            )
+        return self._device_arrays
+
+
+class QuantileSketch(object):
+    """
+    Mergeable streaming sketch of the distribution of one variable, used to
+    find edges with (nearly) equal population without sorting the sample.
+
+    Values are kept in levels; a value at level h stands for 2**h values.
+    Whenever a level holds at least 2*k values, blocks of 2*k values are
+    sorted and every other value (starting at a random one) is promoted to
+    the next level. A sketch of n values thus holds about 2*k*log2(n/k)
+    values and the rank of any value is estimated with an error of about
+    n/k. Sketches of parts of a sample can be merged.
+
+    Values are added in sub-blocks of `n_sub_blocks` * 2*k values, so the
+    memory used besides the levels does not grow with the sample size.
+
+    Parameters
+    ----------
+    k : int
+        Accuracy parameter
+    seed : None or int
+        Seed for choosing the promoted values
+
+    """
+    # Number of blocks of 2*k values which are added at once
+    n_sub_blocks = 16
+
+    def __init__(self, k=4096, seed=None):
+        self.k = k
+        self.levels = []
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._rng = np.random.RandomState(seed)
+
+    def update(self, values):
+        """Add values to the sketch; NaN and inf are ignored"""
+        values = np.asarray(values).ravel()
+        step = self.n_sub_blocks * 2 * self.k
+        for start in range(0, len(values), step):
+            # Only one sub-block is converted at a time
+            sub = values[start:start+step].astype(np.float64)
+            sub = sub[np.isfinite(sub)]
+            if len(sub) == 0:
+                continue
+            self.n += len(sub)
+            self.min = min(self.min, sub.min())
+            self.max = max(self.max, sub.max())
+            self._add(0, sub)
+        return self
+
+    def merge(self, other):
+        """Add all values of another sketch to this one"""
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for level, values in enumerate(other.levels):
+            self._add(level, values)
+        return self
+
+    def _add(self, level, values):
+        step = self.n_sub_blocks * 2 * self.k
+        if len(values) > step:
+            for start in range(0, len(values), step):
+                self._add(level, values[start:start+step])
+            return
+        block = 2 * self.k
+        while len(values) > 0:
+            if len(self.levels) == level:
+                self.levels.append(values[:0])
+            values = np.concatenate((self.levels[level], values))
+            n_blocks = len(values) // block
+            if n_blocks == 0:
+                self.levels[level] = values
+                return
+            blocks = np.sort(values[:n_blocks*block].reshape(n_blocks, block),
+                             axis=1)
+            self.levels[level] = values[n_blocks*block:]
+            offsets = self._rng.randint(2, size=(n_blocks, 1))
+            values = blocks[np.arange(n_blocks)[:, None],
+                            offsets + 2*np.arange(self.k)].ravel()
+            level += 1
+
+    def quantiles(self, q):
+        """Estimate the quantiles `q` (between 0 and 1)"""
+        q = np.asarray(q, dtype=np.float64)
+        if self.n == 0:
+            return np.full(q.shape, np.nan)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2.**h)
+                                  for h, v in enumerate(self.levels)])
+        order = np.argsort(values, kind='mergesort')
+        values = values[order]
+        ranks = np.cumsum(weights[order])
+        idx = np.searchsorted(ranks, q * ranks[-1], side='left')
+        result = values[np.clip(idx, 0, len(values) - 1)]
+        result[q <= 0] = self.min
+        result[q >= 1] = self.max
+        return result
+
+    def edges(self, n_bins, dtype=np.float64):
+        """Edges of `n_bins` bins with about the same number of values each.
+        Edges which coincide (e.g. for discrete values) are merged, so there
+        may be fewer bins."""
+        if self.n == 0 or self.min == self.max:
+            # Like numpy for an empty range
+            center = 0. if self.n == 0 else self.min
+            return np.linspace(center - 0.5, center + 0.5, n_bins + 1,
+                               dtype=dtype)
+        edges = self.quantiles(np.linspace(0, 1, n_bins + 1))
+        return np.unique(edges.astype(dtype))
+
+
+class SummedAreaTable(object):
+    """
+    Cumulative table of a histogram which answers the sum over any
+    axis-aligned box of bins with 2**n_dims lookups.
+
+    The table is built when it is first queried after the histogram changed,
+    so several fills can be added before paying for the prefix sums again.
+
+    Parameters
+    ----------
+    hist : array
+        Counts or weight sums, e.g. the output of `GPUHist.get_hist`
+    edges : None or sequence of arrays
+        Needed to query boxes in coordinates (`sum_values`)
+
+    """
+    def __init__(self, hist, edges=None):
+        hist = np.asarray(hist)
+        dtype = np.float64 if hist.dtype.kind == 'f' else np.int64
+        self.hist = np.array(hist, dtype=dtype)
+        self.edges = None
+        if edges is not None:
+            self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        self._table = None
+
+    def add(self, hist):
+        """Add the counts of another fill; the table is rebuilt lazily"""
+        self.hist += hist
+        self._table = None
+        return self
+
+    @property
+    def table(self):
+        """Prefix sums with a leading zero along each axis, i.e.
+        table[i, j, ...] is the sum of hist[:i, :j, ...]"""
+        if self._table is None:
+            table = np.zeros(tuple(n + 1 for n in self.hist.shape),
+                             dtype=self.hist.dtype)
+            inner = table[(slice(1, None),) * self.hist.ndim]
+            inner[...] = self.hist
+            for axis in range(self.hist.ndim):
+                np.cumsum(inner, axis=axis, out=inner)
+            self._table = table
+        return self._table
+
+    def sum(self, lower, upper):
+        """Sums over the boxes of bins lower[d] <= i_d < upper[d].
+
+        Parameters
+        ----------
+        lower, upper : arrays of shape (n_dims,) or (n_boxes, n_dims)
+            Bin indices; they are clipped to the histogram
+
+        Returns
+        -------
+        Sum for each box
+
+        """
+        table = self.table
+        n_dims = self.hist.ndim
+        shape = np.array(self.hist.shape)
+        lower = np.clip(np.asarray(lower, dtype=np.intp), 0, shape)
+        upper = np.clip(np.asarray(upper, dtype=np.intp), 0, shape)
+        upper = np.maximum(upper, lower)
+        single = lower.ndim == 1
+        lower = np.atleast_2d(lower)
+        upper = np.atleast_2d(upper)
+        total = np.zeros(len(lower), dtype=table.dtype)
+        # Inclusion-exclusion over the corners of each box
+        for corner in range(1 << n_dims):
+            index = []
+            n_lower = 0
+            for d in range(n_dims):
+                if corner >> d & 1:
+                    index.append(upper[:, d])
+                else:
+                    index.append(lower[:, d])
+                    n_lower += 1
+            if n_lower % 2:
+                total -= table[tuple(index)]
+            else:
+                total += table[tuple(index)]
+        return total[0] if single else total
+
+    def sum_values(self, lower, upper):
+        """Sums over the boxes lower[d] <= x_d <= upper[d] in coordinates.
+        Only bins which lie completely inside a box are included."""
+        if self.edges is None:
+            raise ValueError('Querying coordinates needs the edges')
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        lower_bins = np.empty(lower.shape, dtype=np.intp)
+        upper_bins = np.empty(upper.shape, dtype=np.intp)
+        for d, edges in enumerate(self.edges):
+            lower_bins[..., d] = np.searchsorted(edges, lower[..., d],
+                                                 side='left')
+            upper_bins[..., d] = np.searchsorted(edges, upper[..., d],
+                                                 side='right') - 1
+        return self.sum(lower_bins, upper_bins)
+
+
+class Profile(object):
+    """
+    Profile of a target in the bins of a histogram: the sum of the weights,
+    the weighted mean and the weighted sum of squared deviations from the
+    mean (M2) of the target in each bin.
+
+    Profiles of chunks or of separate fills are combined with `merge`, which
+    uses the pairwise update of Chan et al. and thus never subtracts large
+    sums of squares from each other.
+
+    Parameters
+    ----------
+    sum_w, mean, m2 : arrays of the shape of the histogram
+    edges : sequence of arrays
+
+    """
+    def __init__(self, sum_w, mean, m2, edges):
+        self.sum_w = np.asarray(sum_w, dtype=np.float64)
+        self._mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+        self.edges = edges
+
+    @classmethod
+    def from_sums(cls, sum_w, sum_wdy, sum_wdy2, shift, edges):
+        """Profile from the sums of the weights, of w*(y - shift) and of
+        w*(y - shift)**2 as filled by the profile kernel"""
+        sum_w = np.asarray(sum_w, dtype=np.float64)
+        filled = sum_w > 0
+        safe_w = np.where(filled, sum_w, 1)
+        offset = np.where(filled, sum_wdy / safe_w, 0)
+        m2 = np.where(filled, sum_wdy2 - offset * sum_wdy, 0)
+        # Rounding may leave tiny negative values for constant targets
+        return cls(sum_w, shift + offset * filled, np.maximum(m2, 0), edges)
+
+    def merge(self, other):
+        """Add the entries of another profile with the same binning"""
+        sum_w = self.sum_w + other.sum_w
+        filled = sum_w > 0
+        safe_w = np.where(filled, sum_w, 1)
+        delta = other._mean - self._mean
+        self._mean = np.where(filled,
+                              self._mean + delta * other.sum_w / safe_w, 0)
+        self.m2 = self.m2 + other.m2 + np.where(
+            filled, delta**2 * self.sum_w * other.sum_w / safe_w, 0)
+        self.sum_w = sum_w
+        return self
+
+    @property
+    def mean(self):
+        """Weighted mean of the target; NaN in empty bins"""
+        return np.where(self.sum_w > 0, self._mean, np.nan)
+
+    @property
+    def variance(self):
+        """Weighted (population) variance of the target; NaN in empty
+        bins"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.sum_w > 0, self.m2 / self.sum_w, np.nan)
+
+
+class ApproxHist(object):
+    """
+    Approximate histogram of a sample which can be refined progressively.
+
+    The sample is divided into strata of `stride` consecutive events. Each
+    round fills one event of every stratum (at the same, randomly chosen
+    offset in all strata) into the accumulated counts, so each round reads
+    only a fraction 1/stride of the sample. After rounds covering a fraction
+    f of the events, the counts are scaled by 1/f and each bin gets the
+    uncertainty sqrt(counts * (1 - f)) / f of a subsample without
+    replacement. After `stride` rounds the histogram is exact.
+
+    Parameters
+    ----------
+    histogrammer : GPUHist
+    sample : array of shape (n_events, n_dims)
+    bins : See `GPUHist.get_hist`. Edges found automatically (following
+        `auto_edges` in kwargs) are computed from the whole sample with one
+        pass on the host before the first round, so all rounds share them.
+        Samples with transforms need explicit edges.
+    rate : float
+        Fraction of the events filled per round
+    seed : None or int
+        Seed for the order of the offsets
+    kwargs : Further arguments of `GPUHist.get_hist` except for density and
+        return_stats
+
+    """
+    def __init__(self, histogrammer, sample, bins=10, rate=0.01, seed=None,
+                 **kwargs):
+        if kwargs.get('density') or kwargs.get('normed') or \
+                kwargs.get('return_stats'):
+            raise ValueError('Approximate histograms can not be returned as '
+                             'densities or with stats')
+        if not 0 < rate <= 1:
+            raise ValueError('`rate` must be in (0, 1]. Got %s instead.'
+                             % rate)
+        self.histogrammer = histogrammer
+        self.sample = np.asarray(sample)
+        if self.sample.ndim == 1:
+            self.sample = self.sample[:, None]
+        self.n_events = len(self.sample)
+        self.stride = max(int(round(1. / rate)), 1)
+        self.bins = bins
+        self.kwargs = kwargs
+        self.edges = self._edges(bins)
+        self.counts = None
+        self.n_rounds = 0
+        self.n_filled = 0
+        self._offsets = np.random.RandomState(seed).permutation(self.stride)
+
+    def _edges(self, bins):
+        """Edges for `bins` over all events"""
+        if isinstance(bins, Iterable) and \
+                isinstance(list(bins)[0], Iterable):
+            return [np.asarray(e, dtype=self.histogrammer.FTYPE)
+                    for e in bins]
+        if self.kwargs.get('transforms') is not None:
+            raise ValueError('Approximate histograms of transformed samples '
+                             'need explicit edges')
+        if self.kwargs.get('auto_edges', 'linear') != 'quantile':
+            return self.histogrammer._host_edges(self.sample, bins)
+        n_dims = self.sample.shape[1]
+        if not isinstance(bins, Iterable):
+            bins = [bins] * n_dims
+        return [QuantileSketch().update(self.sample[:, d]).edges(
+                    int(bins[d]), dtype=self.histogrammer.FTYPE)
+                for d in range(n_dims)]
+
+    @property
+    def complete(self):
+        return self.n_rounds == self.stride
+
+    @property
+    def fraction(self):
+        """Fraction of the events filled so far"""
+        return self.n_filled / float(max(self.n_events, 1))
+
+    def refine(self, n_rounds=1):
+        """Fill `n_rounds` more subsamples into the counts"""
+        for _ in range(n_rounds):
+            if self.complete:
+                break
+            offset = self._offsets[self.n_rounds]
+            self.n_rounds += 1
+            subsample = self.sample[offset::self.stride]
+            if len(subsample) == 0:
+                continue
+            hist, _ = self.histogrammer.get_hist(subsample, bins=self.edges,
+                                                 **self.kwargs)
+            if self.counts is None:
+                self.counts = np.zeros(hist.shape, dtype=np.float64)
+            self.counts += hist
+            self.n_filled += len(subsample)
+        return self
+
+    @property
+    def hist(self):
+        """Estimated counts of the whole sample"""
+        if self.n_filled == 0:
+            return self.counts
+        return self.counts / self.fraction
+
+    @property
+    def sigma(self):
+        """Uncertainty of each bin of `hist`"""
+        if self.n_filled == 0:
+            return self.counts
+        fraction = self.fraction
+        return np.sqrt(self.counts * max(1. - fraction, 0.)) / fraction
+
+    @property
+    def precision(self):
+        """Largest uncertainty relative to the fullest bin"""
+        hist = self.hist
+        if hist is None or hist.max() <= 0:
+            return np.inf if not self.complete else 0.
+        return self.sigma.max() / hist.max()
+
+
+class MemoryPlan(object):
+    """
+    How `GPUHist.get_hist` fills a histogram within a memory budget, as
+    chosen by `GPUHist.plan_memory`.
+
+    Attributes
+    ----------
+    budget : int
+        Bytes of device memory which may be used
+    kernel_memory : 'shared' or 'global'
+        Where the blocks accumulate their histograms
+    accumulation : 'private', 'accumulator' or 'sparse'
+        'private': each block writes its own copy of the histogram and the
+        copies are summed up at the end. 'accumulator': several blocks share
+        each of `n_copies` copies (or the result itself if `n_copies` is 1).
+        'sparse': not even one histogram fits into the budget, so only the
+        flat bin of each event is written and counted on the host.
+    n_copies : int
+        Number of histogram copies on the device
+    block_dim, grid_dim : tuple
+        Block and (maximum) grid dimensions of the kernels
+    chunk_events : int
+        Number of events which are processed per kernel launch
+    n_chunks : int
+    device_bytes : int
+        Estimated device memory used by the plan
+
+    """
+    def __init__(self, budget, kernel_memory, accumulation, n_copies,
+                 block_dim, grid_dim, chunk_events, n_chunks, device_bytes):
+        self.budget = budget
+        self.kernel_memory = kernel_memory
+        self.accumulation = accumulation
+        self.n_copies = n_copies
+        self.block_dim = block_dim
+        self.grid_dim = grid_dim
+        self.chunk_events = chunk_events
+        self.n_chunks = n_chunks
+        self.device_bytes = device_bytes
+
+    def __str__(self):
+        return ("Memory plan: %s memory, %s accumulation with %d histogram "
+                "copies, %d chunk(s) of %d events, %d blocks of %d threads, "
+                "%.1f of %.1f Mbytes"
+                % (self.kernel_memory, self.accumulation, self.n_copies,
+                   self.n_chunks, self.chunk_events, self.grid_dim[0],
+                   self.block_dim[0], self.device_bytes/(1024.*1024),
+                   self.budget/(1024.*1024)))
+
+
+class HistSpec(object):
+    """
+    One of the histograms filled by `GPUHist.fill_many`.
+
+    Parameters
+    ----------
+    columns : sequence of int
+        Columns of the sample which are the dimensions of the histogram
+    edges : sequence of arrays
+        Edges for each of `columns`, including the rightmost edge
+    weight_column : None or int
+        Column holding the weight of each event. Weighted histograms hold
+        the sum of weights in each bin.
+
+    """
+    def __init__(self, columns, edges, weight_column=None):
+        self.columns = [int(c) for c in columns]
+        self.edges = list(edges)
+        if len(self.columns) != len(self.edges):
+            raise ValueError('Got edges for %d dimensions but %d columns'
+                             % (len(self.edges), len(self.columns)))
+        self.weight_column = weight_column
+
+
+# Codes of the derived variables in the kernels (TRANSFORM_*)
+TRANSFORM_KINDS = {'column': 0, 'affine': 0, 'clip': 0, 'log': 1, 'log10': 2,
+                   'cos': 3, 'ratio': 4, 'product': 5}
+
+
+class Transform(object):
+    """
+    Derived variable for one dimension of a histogram. It is computed from
+    the columns of the sample on the device, one chunk at a time, right
+    before binning, so no array of the derived variable is ever created.
+
+    The value is `kind` applied to `column` (and `other` for 'ratio' and
+    'product'), then `scale * value + offset` and then clipped to `clip`.
+
+    Parameters
+    ----------
+    kind : one of `TRANSFORM_KINDS`
+        'column', 'affine' and 'clip' take the column as it is
+    column : int
+    other : None or int
+        Second column of 'ratio' (column / other) and 'product'
+    scale, offset : float
+    clip : None or (low, high)
+        Clipped values fall into the first or last bin if the edges include
+        the bounds
+
+    """
+    def __init__(self, kind, column, other=None, scale=1, offset=0,
+                 clip=None):
+        if kind not in TRANSFORM_KINDS:
+            raise ValueError('`kind` must be one of %s. Got %s instead.'
+                             % (sorted(TRANSFORM_KINDS), kind))
+        if kind in ('ratio', 'product') and other is None:
+            raise ValueError('%s needs the `other` column' % kind)
+        self.kind = kind
+        self.column = int(column)
+        self.other = self.column if other is None else int(other)
+        self.scale = scale
+        self.offset = offset
+        self.clip = (-np.inf, np.inf) if clip is None else tuple(clip)
+
+    @classmethod
+    def to_arrays(cls, transforms, n_columns, ftype=FTYPE):
+        """Arrays `transform_info` and `transform_params` of the kernel.
+        Integers in `transforms` stand for the column as it is."""
+        info = np.zeros((len(transforms), 3), dtype=np.uint32)
+        params = np.zeros((len(transforms), 4), dtype=ftype)
+        for d, transform in enumerate(transforms):
+            if not isinstance(transform, Transform):
+                transform = cls('column', transform)
+            for column in (transform.column, transform.other):
+                if not 0 <= column < n_columns:
+                    raise ValueError('Column %d does not exist in a sample '
+                                     'with %d columns' % (column, n_columns))
+            info[d] = (TRANSFORM_KINDS[transform.kind], transform.column,
+                       transform.other)
+            params[d] = (transform.scale, transform.offset) + transform.clip
+        return info.ravel(), params.ravel()
+
+
+class Selection(object):
+    """
+    Events selected for a fill as a packed bitmask in the bit order of
+    `np.packbits` (event 0 is the most significant bit of the first byte).
+    The bitmask takes one bit per event, so many selections of a sample can
+    be kept on the device at once.
+
+    Parameters
+    ----------
+    bits : uint8 array of length ceil(n_events/8)
+    n_events : int
+
+    """
+    def __init__(self, bits, n_events):
+        self.bits = np.ascontiguousarray(bits, dtype=np.uint8)
+        self.n_events = int(n_events)
+        if len(self.bits) != (self.n_events + 7) // 8:
+            raise ValueError('A bitmask of %d events needs %d bytes, got %d'
+                             % (self.n_events, (self.n_events + 7) // 8,
+                                len(self.bits)))
+
+    @classmethod
+    def from_array(cls, selection, n_events):
+        """Selection from a boolean mask, an index array or a `Selection`"""
+        if isinstance(selection, Selection):
+            if selection.n_events != n_events:
+                raise ValueError('The selection is for %d events but the '
+                                 'sample has %d'
+                                 % (selection.n_events, n_events))
+            return selection
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            if len(selection) != n_events:
+                raise ValueError('The mask has %d entries but the sample has '
+                                 '%d events' % (len(selection), n_events))
+            return cls(np.packbits(selection), n_events)
+        if selection.dtype.kind in 'iu':
+            # The bits are set directly, without a mask of all events
+            index = selection.astype(np.int64).ravel()
+            index[index < 0] += n_events
+            if np.any((index < 0) | (index >= n_events)):
+                raise IndexError('The selection has indices outside of the '
+                                 '%d events' % n_events)
+            bits = np.zeros((n_events + 7) // 8, dtype=np.uint8)
+            # Same bit order as `np.packbits`
+            np.bitwise_or.at(bits, index >> 3,
+                             (128 >> (index & 7)).astype(np.uint8))
+            return cls(bits, n_events)
+        raise ValueError('A selection must be a boolean mask, an index array '
+                         'or a `Selection`. Got %s instead.' % selection.dtype)
+
+    def mask(self, start=0, stop=None):
+        """Boolean mask of the events from start to stop"""
+        if stop is None:
+            stop = self.n_events
+        first = start // 8
+        bits = np.unpackbits(self.bits[first:(stop + 7) // 8])
+        return bits[start - 8*first:stop - 8*first].astype(bool)
+
+
+class FillPlan(object):
+    """
+    Binning of a histogram prepared once for many fills, like an FFT plan.
+
+    The edges are validated and copied to the device, the kernels are
+    compiled and the launch configuration is fixed when the plan is made.
+    Device buffers are allocated by the first fill and reused as long as
+    they are large enough. `fill` then only copies the sample, launches the
+    kernels and copies the histogram back. Samples must fit into device
+    memory; use `GPUHist.get_hist` for larger ones.
+
+    Since the buffers are reused, a plan must not be filled by several
+    threads at once; make one plan per thread instead.
+
+    Parameters
+    ----------
+    histogrammer : GPUHist
+    edges : sequence of arrays
+        Edges for each dimension, including the rightmost edge
+    dims : None or int
+        Number of dimensions of the samples; must match the edges
+    weighted : bool
+        If True, each fill takes weights and returns their sum per bin
+    sample_dtype : None or dtype
+        Type of the samples (default is ftype). Kernels for other types are
+        compiled when they are first filled.
+    shared : bool
+        Use shared memory if the histogram fits
+    out_of_range : 'drop' or 'clamp'
+    density : bool
+        Return the probability density like `GPUHist.get_hist`
+    deterministic : bool
+        Sum the weights as fixed-point integers with `fraction_bits`
+        fractional bits. Each weight is rounded to a multiple of
+        2**-fraction_bits once, and the integer sums are exact, so the
+        result is bit-identical for any number of threads, blocks, chunks or
+        processes. Fills whose absolute weights add up to 2**(63 -
+        fraction_bits) or more raise an OverflowError.
+    fraction_bits : int
+
+    """
+    def __init__(self, histogrammer, edges, dims=None, weighted=False,
+                 sample_dtype=None, shared=True, out_of_range='drop',
+                 density=False, deterministic=False, fraction_bits=32):
+        self.histogrammer = histogrammer
+        self.edge_set = histogrammer.get_edge_set(edges)
+        self.edges = self.edge_set.edges
+        self.n_dims = self.edge_set.n_dims
+        if dims is not None and dims != self.n_dims:
+            raise ValueError('Got edges for %d dimensions but dims is %d'
+                             % (self.n_dims, dims))
+        self.shape = self.edge_set.n_bins
+        self.n_flat_bins = self.edge_set.n_flat_bins
+        self.weighted = weighted
+        self.density = density
+        self.deterministic = deterministic
+        self.fraction_bits = int(fraction_bits)
+        self.scale = float(2**self.fraction_bits)
+        if out_of_range not in ('drop', 'clamp'):
+            raise ValueError("`out_of_range` must be 'drop' or 'clamp'. "
+                             "Got %s instead." % out_of_range)
+        self.flow_mode = histogrammer.ITYPE(OUT_OF_RANGE_MODES[out_of_range])
+        if sample_dtype is None:
+            sample_dtype = histogrammer.FTYPE
+        self.sample_dtype = np.dtype(sample_dtype)
+        self.kernels = histogrammer.get_kernels(self.sample_dtype)
+        self._edge_args = self.edge_set.to_device(histogrammer.ITYPE)
+
+        memory_plan = histogrammer.plan_memory(
+            1, self.n_dims, self.n_flat_bins, self.sample_dtype.itemsize,
+            shared=shared)
+        self.block_dim = memory_plan.block_dim
+        self.max_blocks = min(
+            2 * histogrammer.mp
+            * max(histogrammer.threads_per_mp // self.block_dim[0], 1),
+            histogrammer.max_grid_dim_x)
+        self.shared = memory_plan.kernel_memory == 'shared'
+        self._shared_bytes = 0
+        if self.shared:
+            self._shared_bytes = (self.n_flat_bins
+                                  * np.dtype(histogrammer.HIST_TYPE).itemsize)
+        self._length_t = histogrammer.HIST_TYPE
+        self._buffers = {}
+
+    def _buffer(self, name, n_bytes):
+        """Device buffer which is only reallocated if it is too small"""
+        d_buffer, size = self._buffers.get(name, (None, 0))
+        if size < n_bytes:
+            if d_buffer is not None:
+                d_buffer.free()
+            d_buffer = cuda.mem_alloc(max(n_bytes, 1))
+            self._buffers[name] = (d_buffer, n_bytes)
+        return d_buffer
+
+    @_in_context
+    def fill(self, sample, weights=None, n_events=None, offsets=None,
+             fixed=False, weights_per=None):
+        """Histogram a sample with the planned binning
+
+        Parameters
+        ----------
+        sample : array of shape (n_events, n_dims) or a device array
+        weights : array of shape (n_events,); required for weighted plans
+        n_events : int; required for device arrays
+        offsets : None or array of shape (n_jagged_events+1,)
+            Jagged sample: its rows are the entries of all events one after
+            another and event e owns the rows from offsets[e] to
+            offsets[e+1]. The offsets start at 0 and end at the number of
+            rows. The weights may then be given per event and are applied
+            to each entry of the event on the device.
+        fixed : bool
+            Return the fixed-point sums of a deterministic plan as int64.
+            Sums of several fills (e.g. from other processes) can be added
+            exactly and converted with `from_fixed`.
+        weights_per : None, 'event' or 'entry'
+            Whether the weights of a jagged sample belong to the events or
+            to the entries. By default this follows from the number of
+            weights; if there are as many events as entries, but some events
+            do not have exactly one entry, it must be given.
+
+        Returns
+        -------
+        hist
+
+        """
+        hgram = self.histogrammer
+        n_dims = self.n_dims
+        kernels = self.kernels
+        if isinstance(sample, cuda.DeviceAllocation):
+            if n_events is None:
+                raise ValueError('`n_events` is needed for device arrays')
+            d_sample = sample
+        else:
+            sample = np.ascontiguousarray(sample)
+            if sample.ndim == 1:
+                sample = sample.reshape(-1, 1)
+            if sample.shape[1] != n_dims:
+                raise ValueError('The plan is for %d dimensions but the '
+                                 'sample has %d' % (n_dims, sample.shape[1]))
+            n_events = len(sample)
+            if sample.dtype != self.sample_dtype:
+                kernels = hgram.get_kernels(sample.dtype)
+            d_sample = self._buffer('sample', sample.nbytes)
+            cuda.memcpy_htod(d_sample, sample)
+        if self.weighted != (weights is not None):
+            raise ValueError('Weights must be given if and only if the plan '
+                             'is weighted')
+
+        dx, mx = divmod(n_events, self.block_dim[0])
+        grid_dim = (max(min(dx + (mx>0), self.max_blocks), 1), 1)
+        length = self._length_t(n_events*n_dims)
+        if offsets is not None:
+            offsets = np.ascontiguousarray(offsets, dtype=hgram.ITYPE)
+            if offsets.ndim != 1 or len(offsets) < 1 or offsets[0] != 0 \
+                    or offsets[-1] != n_events \
+                    or np.any(offsets[1:] < offsets[:-1]):
+                raise ValueError('The offsets must ascend from 0 to the %d '
+                                 'entries of the sample' % n_events)
+            n_jagged = len(offsets) - 1
+        if self.weighted:
+            weights = np.ascontiguousarray(weights, dtype=hgram.FTYPE)
+            if weights_per not in (None, 'event', 'entry'):
+                raise ValueError("`weights_per` must be None, 'event' or "
+                                 "'entry'. Got %s instead." % weights_per)
+            per_event = False
+            if offsets is not None and weights_per is not None:
+                per_event = weights_per == 'event'
+            elif offsets is not None and len(weights) == n_jagged:
+                per_event = True
+                if n_jagged == n_events:
+                    # One entry per event needs no offsets
+                    if not np.all(np.diff(offsets) == 1):
+                        raise ValueError('There are as many events as '
+                                         'entries; pass `weights_per` to '
+                                         'tell how the weights are meant')
+                    per_event = False
+            if per_event and len(weights) != n_jagged:
+                raise ValueError('Got %d weights for %d events and %d entries'
+                                 % (len(weights), n_jagged, n_events))
+            elif not per_event and len(weights) != n_events:
+                raise ValueError('Got %d weights for %d events'
+                                 % (len(weights), n_events))
+            d_weights = self._buffer('weights', weights.nbytes)
+            cuda.memcpy_htod(d_weights, weights)
+        if self.weighted and self.deterministic:
+            if per_event:
+                n_entries = np.diff(offsets).astype(np.float64)
+                total = np.abs(weights).astype(np.float64).dot(n_entries)
+            else:
+                total = np.abs(weights).astype(np.float64).sum()
+            if not total * self.scale < 2.0**63:
+                raise OverflowError('The weights add up to %g which does not '
+                                    'fit into the fixed-point sums with %d '
+                                    'fractional bits'
+                                    % (total, self.fraction_bits))
+            hist = np.empty(self.n_flat_bins, dtype=np.int64)
+            d_hist = self._buffer('hist', hist.nbytes)
+            cuda.memset_d8(d_hist, 0, hist.nbytes)
+            if per_event:
+                d_offsets = self._buffer('offsets', offsets.nbytes)
+                cuda.memcpy_htod(d_offsets, offsets)
+            else:
+                d_offsets, n_jagged = np.intp(0), n_events
+            args = ((d_sample, length, hgram.ITYPE(n_dims), d_offsets,
+                     hgram.ITYPE(n_jagged), d_weights, np.float64(self.scale),
+                     d_hist)
+                    + self._edge_args + (self.flow_mode, np.intp(0)))
+            kernels['hist_gmem_weighted_fixed_given_edges'](*args,
+                    block=self.block_dim, grid=grid_dim)
+        elif self.weighted:
+            hist = np.empty(self.n_flat_bins, dtype=hgram.FTYPE)
+            d_hist = self._buffer('hist', hist.nbytes)
+            cuda.memset_d8(d_hist, 0, hist.nbytes)
+            if per_event:
+                d_offsets = self._buffer('offsets', offsets.nbytes)
+                cuda.memcpy_htod(d_offsets, offsets)
+                args = ((d_sample, length, hgram.ITYPE(n_dims), d_offsets,
+                         hgram.ITYPE(n_jagged), d_weights, d_hist)
+                        + self._edge_args + (self.flow_mode, np.intp(0)))
+                kernels['hist_gmem_jagged_weighted_given_edges'](*args,
+                        block=self.block_dim, grid=grid_dim)
+            else:
+                args = ((d_sample, length, hgram.ITYPE(n_dims), d_weights,
+                         d_hist)
+                        + self._edge_args + (self.flow_mode, np.intp(0)))
+                kernels['hist_gmem_weighted_given_edges'](*args,
+                        block=self.block_dim, grid=grid_dim)
+        else:
+            hist = np.empty(self.n_flat_bins, dtype=hgram.HIST_TYPE)
+            n_copies = grid_dim[0]
+            d_partials = self._buffer('partials', n_copies * hist.nbytes)
+            cuda.memset_d32(d_partials, 0, n_copies * self.n_flat_bins)
+            if self.shared:
+                kernel = kernels['hist_smem_given_edges']
+            else:
+                kernel = kernels['hist_gmem_given_edges']
+            args = ((d_sample, length, self._length_t(n_dims),
+                     self._length_t(self.n_flat_bins), d_partials)
+                    + self._edge_args
+                    + (self.flow_mode, hgram.ITYPE(0), hgram.ITYPE(n_copies)))
+            kernel(*args, block=self.block_dim, grid=grid_dim,
+                   shared=self._shared_bytes)
+            if n_copies > 1:
+                d_hist = self._buffer('hist', hist.nbytes)
+                dx, mx = divmod(self.n_flat_bins, self.block_dim[0])
+                kernels['hist_accum'](d_partials, hgram.ITYPE(n_copies),
+                        d_hist, self._length_t(self.shape[0]),
+                        self._length_t(self.n_flat_bins),
+                        self._length_t(n_dims), block=self.block_dim,
+                        grid=(max(min(dx + (mx>0), self.max_blocks), 1), 1))
+            else:
+                d_hist = d_partials
+        cuda.memcpy_dtoh(hist, d_hist)
+        hist = hist.reshape(self.shape)
+        if self.weighted and self.deterministic:
+            if fixed:
+                return hist
+            hist = self.from_fixed(hist)
+        if self.density:
+            hist = self.edge_set.density(hist)
+        return hist
+
+    def from_fixed(self, sums):
+        """Weight sums from the fixed-point sums of a deterministic plan"""
+        return (np.asarray(sums, dtype=np.float64)
+                / self.scale).astype(self.histogrammer.FTYPE)
+
+    @_in_context
+    def free(self):
+        """Free the device buffers"""
+        for d_buffer, size in self._buffers.values():
+            d_buffer.free()
+        self._buffers = {}
+
+
+class RollingHist(object):
+    """
+    Histogram of the events of the last `n_intervals` intervals of a stream.
+
+    Each interval is filled into its own sub-histogram of a ring buffer and
+    into the window total. `advance` starts the next interval and subtracts
+    the sub-histogram which leaves the window from the total, so refreshing
+    the window costs one interval fill instead of a fill of the whole
+    window. Weighted totals are summed up again from the ring once per
+    revolution, so rounding errors of the subtractions do not pile up.
+
+    Parameters
+    ----------
+    histogrammer : GPUHist
+    edges : sequence of arrays
+        Edges for each dimension, including the rightmost edge
+    n_intervals : int
+        Number of intervals in the window
+    weighted : bool
+        If True, fills take weights and the histogram holds their sums
+    kwargs : Further arguments of `FillPlan` except for density
+
+    """
+    def __init__(self, histogrammer, edges, n_intervals, weighted=False,
+                 **kwargs):
+        if n_intervals < 1:
+            raise ValueError('`n_intervals` must be at least 1. Got %s '
+                             'instead.' % n_intervals)
+        self.plan = histogrammer.make_plan(edges, weighted=weighted, **kwargs)
+        self.edges = self.plan.edges
+        self.n_intervals = int(n_intervals)
+        dtype = np.float64 if weighted else np.int64
+        self.ring = np.zeros((self.n_intervals,) + tuple(self.plan.shape),
+                             dtype=dtype)
+        self.total = np.zeros(self.plan.shape, dtype=dtype)
+        self.current = 0
+        self.n_advances = 0
+
+    def fill(self, sample, weights=None):
+        """Add events to the current interval"""
+        hist = self.plan.fill(sample, weights=weights)
+        self.ring[self.current] += hist
+        self.total += hist
+        return self
+
+    def advance(self):
+        """Start the next interval; the oldest one leaves the window"""
+        self.current = (self.current + 1) % self.n_intervals
+        self.n_advances += 1
+        self.total -= self.ring[self.current]
+        self.ring[self.current] = 0
+        if self.total.dtype.kind == 'f' and self.current == 0:
+            self.total = self.ring.sum(axis=0)
+        return self
+
+    @property
+    def hist(self):
+        """Histogram of the window"""
+        return self.total.copy()
+
+    def free(self):
+        """Free the device buffers of the plan"""
+        self.plan.free()
+
+
+class DecayedHist(object):
+    """
+    Histogram in which each event is weighted with exp(-ln(2) * age /
+    half_life), for monitoring streams without a hard window.
+
+    The decay is applied lazily: fills are added with the growth factor
+    exp(ln(2) * (t - t_ref) / half_life) relative to a reference time and
+    the histogram is only scaled when it is read. The bins are rescaled and
+    the reference time is moved only when the growth factor gets large, so
+    a tick costs the fill of the new events.
+
+    Parameters
+    ----------
+    histogrammer : GPUHist
+    edges : sequence of arrays
+        Edges for each dimension, including the rightmost edge
+    half_life : float
+        In units of the time passed to `advance`
+    weighted : bool
+        If True, fills take weights
+    kwargs : Further arguments of `FillPlan` except for density
+
+    """
+    # Rescale the bins when fills grow by more than this factor
+    max_growth = 2.0**64
+
+    def __init__(self, histogrammer, edges, half_life, weighted=False,
+                 **kwargs):
+        if half_life <= 0:
+            raise ValueError('`half_life` must be positive. Got %s instead.'
+                             % half_life)
+        self.plan = histogrammer.make_plan(edges, weighted=weighted, **kwargs)
+        self.edges = self.plan.edges
+        self.rate = np.log(2) / half_life
+        self.scaled = np.zeros(self.plan.shape, dtype=np.float64)
+        self.time = 0.
+        self.t_ref = 0.
+
+    def fill(self, sample, weights=None):
+        """Add events at the current time"""
+        hist = self.plan.fill(sample, weights=weights)
+        growth = np.exp(self.rate * (self.time - self.t_ref))
+        if growth > self.max_growth:
+            self.scaled *= 1. / growth
+            self.t_ref = self.time
+            growth = 1.
+        self.scaled += growth * hist
+        return self
+
+    def advance(self, dt=1.):
+        """Let time pass; nothing is rescaled"""
+        self.time += dt
+        return self
+
+    @property
+    def hist(self):
+        """Decayed histogram at the current time"""
+        return self.scaled * np.exp(-self.rate * (self.time - self.t_ref))
+
+    def free(self):
+        """Free the device buffers of the plan"""
+        self.plan.free()
+
 
-#TODO: Add more comments. Remove edges array and add multidimensional edge array.
 class GPUHist(object):
     """
     Histogramming class for GPUs
@@ -31,12 +1225,39 @@ class GPUHist(object):
     Parameters
     ----------
     ftype : np.float64 or np.float32
+    memory_budget : int or None
+        Bytes of device memory a histogram may use. If None, a fraction
+        `memory_fraction` of the memory which is free at each call is used.
+
+    One instance can be shared by several threads. All state of a fill is
+    local to the call, the caches are guarded by a lock and the results of
+    the last fill (`hist`, `calc_time`, `memory_plan`, ...) are kept per
+    thread. The CUDA context which is current when the instance is created
+    is made current in the calling thread for each fill.
 
     """
-    def __init__(self, ftype=FTYPE):
+    max_cached_edge_sets = 64
+    memory_fraction = 0.9
+
+    hist = _thread_local('hist', 'Histogram of the last fill')
+    calc_time = _thread_local('calc_time', 'Seconds of the last fill')
+    memory_plan = _thread_local('memory_plan',
+                                '`MemoryPlan` of the last fill')
+    sketches = _thread_local('sketches', 'Quantile sketches of the last '
+                             'fill with quantile edges')
+    approx = _thread_local('approx', '`ApproxHist` of the last '
+                           '`get_hist_approx`')
+    profile = _thread_local('profile', '`Profile` of the last `get_profile`')
+
+    def __init__(self, ftype=FTYPE, memory_budget=None):
         t0 = time.time()
 
+        self.context = cuda.Context.get_current()
+        self._lock = threading.RLock()
+        self._local = threading.local()
         self.FTYPE = ftype
+        self.memory_budget = memory_budget
+        self.memory_plan = None
         self.C_ITYPE = 'unsigned int'
         self.ITYPE = np.uint32
         self.HIST_TYPE = np.uint32
@@ -55,28 +1276,15 @@ class GPUHist(object):
             raise ValueError('Invalid `ftype` specified; must be either'
                              ' `numpy.float32` or `numpy.float64`')
 
-        # Might be useful. PISA used it for atomic cuda_utils.h with
-        # custom atomic_add for floats and doubles.
-        #include_dirs = [os.path.abspath(find_resource('../gpu_hist'))]
-        kernel_code = open("gpu_hist/histogram_atomics.cu", "r").read() %dict(
-            c_precision_def=self.C_PRECISION_DEF,
-            c_ftype=self.C_FTYPE,
-            c_itype=self.C_ITYPE,
-            c_uitype=self.C_HIST_TYPE,
-            c_changetype=self.C_CHANGETYPE
-        )
-        include_dirs = ['/gpu_hist']
-        # keep for compiler output, no_extern_c: allow name manling
-        module = SourceModule(kernel_code, keep=True,
-                options=['--compiler-options','-Wall', '-g'],
-                include_dirs=include_dirs, no_extern_c=False)
-        #module = SourceModule(kernel_code, include_dirs=include_dirs, keep=True)
-        self.max_min_reduce = module.get_function("max_min_reduce")
-        self.hist_gmem = module.get_function("histogram_gmem_atomics")
-        self.hist_gmem_given_edges = module.get_function("histogram_gmem_atomics_with_edges")
-        self.hist_smem = module.get_function("histogram_smem_atomics")
-        self.hist_smem_given_edges = module.get_function("histogram_smem_atomics_with_edges")
-        self.hist_accum = module.get_function("histogram_final_accum")
+        # Kernels for each sample type; compiled when first needed
+        self._kernels = {}
+        kernels = self.get_kernels(self.FTYPE)
+        self.max_min_reduce = kernels['max_min_reduce']
+        self.hist_gmem = kernels['hist_gmem']
+        self.hist_gmem_given_edges = kernels['hist_gmem_given_edges']
+        self.hist_smem = kernels['hist_smem']
+        self.hist_smem_given_edges = kernels['hist_smem_given_edges']
+        self.hist_accum = kernels['hist_accum']
 
         gpu_attributes = cuda.Device(0).get_attributes()
         # See https://documen.tician.de/pycuda/driver.html
@@ -97,6 +1305,7 @@ class GPUHist(object):
         self.mp = gpu_attributes.get(
                 cuda.device_attribute.MULTIPROCESSOR_COUNT)
         self.memory, total = cuda.mem_get_info()
+        self._edge_sets = {}
 
         # print "################################################################"
         # print "Your device has following attributes:"
@@ -112,23 +1321,330 @@ class GPUHist(object):
         # print "################################################################"
         self.init_time = time.time() - t0
 
+    def get_kernels(self, sample_dtype):
+        """Return the kernels for samples of type `sample_dtype` as a dict.
+        The kernels read the sample directly and convert each value in
+        registers, so samples never need to be converted on the host. They
+        are compiled once per sample type."""
+        sample_dtype = np.dtype(sample_dtype)
+        kernels = self._kernels.get(sample_dtype)
+        if kernels is not None:
+            return kernels
+        with self._lock:
+            if sample_dtype not in self._kernels:
+                self._kernels[sample_dtype] = self._compile(sample_dtype)
+            return self._kernels[sample_dtype]
+
+    def _compile(self, sample_dtype):
+        """Compile the kernels for samples of type `sample_dtype`"""
+        if sample_dtype not in SAMPLE_TYPES:
+            raise ValueError('Unsupported sample type %s; must be one of %s'
+                             % (sample_dtype,
+                                sorted(str(t) for t in SAMPLE_TYPES)))
+        c_stype, c_sample_kind = SAMPLE_TYPES[sample_dtype]
+
+        # Might be useful. PISA used it for atomic cuda_utils.h with
+        # custom atomic_add for floats and doubles.
+        #include_dirs = [os.path.abspath(find_resource('../gpu_hist'))]
+        kernel_code = open("gpu_hist/histogram_atomics.cu", "r").read() %dict(
+            c_precision_def=self.C_PRECISION_DEF,
+            c_ftype=self.C_FTYPE,
+            c_itype=self.C_ITYPE,
+            c_uitype=self.C_HIST_TYPE,
+            c_changetype=self.C_CHANGETYPE,
+            c_stype=c_stype,
+            c_sample_kind=c_sample_kind
+        )
+        include_dirs = ['/gpu_hist']
+        # keep for compiler output, no_extern_c: allow name manling
+        module = SourceModule(kernel_code, keep=True,
+                options=['--compiler-options','-Wall', '-g'],
+                include_dirs=include_dirs, no_extern_c=False)
+        #module = SourceModule(kernel_code, include_dirs=include_dirs, keep=True)
+        kernels = {
+            'max_min_reduce': module.get_function("max_min_reduce"),
+            'hist_gmem': module.get_function("histogram_gmem_atomics"),
+            'hist_gmem_given_edges': module.get_function(
+                "histogram_gmem_atomics_with_edges"),
+            'hist_smem': module.get_function("histogram_smem_atomics"),
+            'hist_smem_given_edges': module.get_function(
+                "histogram_smem_atomics_with_edges"),
+            'hist_accum': module.get_function("histogram_final_accum"),
+            'lookup_given_edges': module.get_function(
+                "histogram_lookup_with_edges"),
+            'hist_gmem_weighted_given_edges': module.get_function(
+                "histogram_gmem_weighted_with_edges"),
+            'hist_gmem_weighted_fixed_given_edges': module.get_function(
+                "histogram_gmem_weighted_fixed_with_edges"),
+            'hist_gmem_jagged_weighted_given_edges': module.get_function(
+                "histogram_gmem_jagged_weighted_with_edges"),
+            'transform_columns': module.get_function("transform_columns"),
+            'hist_bootstrap_given_edges': module.get_function(
+                "histogram_bootstrap_with_edges"),
+            'hist_profile_given_edges': module.get_function(
+                "histogram_profile_with_edges"),
+            'hist_selected_given_edges': module.get_function(
+                "histogram_gmem_selected_with_edges"),
+            'hist_multi': module.get_function("histogram_multi_gmem_atomics"),
+            'flat_bins': module.get_function("histogram_flat_bins"),
+            'flat_bins_given_edges': module.get_function(
+                "histogram_flat_bins_with_edges"),
+        }
+        return kernels
+
+    def get_edge_set(self, edges):
+        """Return the (cached) `EdgeSet` for the given edges"""
+        key = EdgeSet.key(edges)
+        with self._lock:
+            edge_set = self._edge_sets.get(key)
+            if edge_set is None:
+                # Edges calculated from the data would fill up the cache.
+                # Fills which still use an evicted edge set keep it alive.
+                if len(self._edge_sets) >= self.max_cached_edge_sets:
+                    self._edge_sets.clear()
+                edge_set = EdgeSet(edges, ftype=self.FTYPE)
+                self._edge_sets[key] = edge_set
+        return edge_set
+
+    def plan_memory(self, n_events, n_dims, histo_length, sample_itemsize,
+                    sample_on_device=False, shared=True, memory_budget=None,
+                    event_bytes=None, buffer_bytes=0):
+        """Choose how to fill a histogram without exceeding a memory budget.
+
+        Samples on the host are copied to the device in chunks which use at
+        most half of the budget. The rest holds as many copies of the
+        histogram as there are blocks; if they do not fit, fewer copies are
+        shared by the blocks, and if not even one copy fits, the flat bins of
+        the events are counted on the host.
+
+        Parameters
+        ----------
+        n_events, n_dims : int
+        histo_length : int
+            Number of bins including the out-of-range counters
+        sample_itemsize : int
+            Bytes per value of the sample
+        sample_on_device : bool
+            If True, the sample is not copied and is not chunked unless the
+            flat bins of all events or the buffer do not fit into the budget
+        shared : bool
+            Use shared memory if the histogram fits
+        memory_budget : int or None
+            Bytes of device memory. Defaults to the budget given at
+            construction or a fraction of the free memory.
+        event_bytes : int or None
+            Bytes per event of the sample if its columns are not the
+            dimensions (e.g. for transforms). Defaults to
+            n_dims * sample_itemsize.
+        buffer_bytes : int
+            Bytes per event of device buffers which hold each chunk in
+            addition to the sample (e.g. the transformed columns). They are
+            counted like the staged sample, also for samples on the device.
+
+        Returns
+        -------
+        MemoryPlan
+
+        Raises
+        ------
+        MemoryError
+            If the histogram does not fit into host memory or the budget
+            is too small for a single block
+
+        """
+        sizeof_hist_t = np.dtype(self.HIST_TYPE).itemsize
+        sizeof_c_ftype = np.dtype(self.C_FTYPE).itemsize
+        hist_bytes = histo_length * sizeof_hist_t
+        if event_bytes is None:
+            event_bytes = n_dims * sample_itemsize
+        n_events = max(int(n_events), 1)
+
+        if memory_budget is None:
+            memory_budget = self.memory_budget
+        if memory_budget is None:
+            free, total = cuda.mem_get_info()
+            memory_budget = int(free * self.memory_fraction)
+        # The histogram is always returned as a dense host array
+        if virtual_memory is not None and \
+                hist_bytes > virtual_memory().available:
+            raise MemoryError('A histogram with %d bins does not fit into '
+                              'host memory' % histo_length)
+
+        # We use a one-dimensional block and grid.
+        # We use as many threads per block as possible but we are limited
+        # to the shared memory.
+        no_of_threads = (self.shared_memory // sizeof_c_ftype * 2)
+        if no_of_threads > self.max_threads_per_block:
+            overflow = self.max_threads_per_block%n_dims
+            block_dim = (self.max_threads_per_block-overflow, 1, 1)
+        else:
+            overflow = no_of_threads%n_dims
+            block_dim = (no_of_threads-overflow, 1, 1)
+        # More blocks than the device can run at once only need more copies
+        # of the histogram
+        resident_blocks = self.mp * max(self.threads_per_mp // block_dim[0], 1)
+        max_blocks = min(2 * resident_blocks, self.max_grid_dim_x)
+
+        # Device memory per event of a chunk
+        staged_event_bytes = buffer_bytes
+        if not sample_on_device:
+            staged_event_bytes += event_bytes
+        if staged_event_bytes == 0:
+            chunk_events = n_events
+        else:
+            chunk_events = min(n_events,
+                               max(memory_budget // 2 // staged_event_bytes, 1))
+        staged_bytes = chunk_events * staged_event_bytes
+        available = memory_budget - staged_bytes
+        if available < hist_bytes and staged_event_bytes > 0:
+            # Rather use smaller chunks than no histogram on the device
+            fewer_events = (memory_budget - hist_bytes) // staged_event_bytes
+            if fewer_events >= min(block_dim[0], n_events):
+                chunk_events = min(fewer_events, n_events)
+                staged_bytes = chunk_events * staged_event_bytes
+                available = memory_budget - staged_bytes
+        n_blocks = min(-(-chunk_events // block_dim[0]), max_blocks)
+
+        if shared and hist_bytes <= self.shared_memory:
+            kernel_memory = 'shared'
+        else:
+            kernel_memory = 'global'
+        if n_blocks == 1 and available >= hist_bytes:
+            accumulation = 'private'
+            n_copies = 1
+        elif available >= (n_blocks + 1) * hist_bytes:
+            accumulation = 'private'
+            n_copies = n_blocks
+        elif available >= hist_bytes:
+            accumulation = 'accumulator'
+            n_copies = available // hist_bytes - 1
+            # Without a second copy, the only copy is the result
+            if n_copies < 2:
+                n_copies = 1
+        else:
+            accumulation = 'sparse'
+            n_copies = 0
+            kernel_memory = 'global'
+            # The flat bin of each event takes 4 bytes
+            per_event = 4 + staged_event_bytes
+            chunk_events = min(n_events, memory_budget // per_event)
+            if chunk_events < block_dim[0]:
+                raise MemoryError('A memory budget of %d bytes is too small '
+                                  'to histogram %d events'
+                                  % (memory_budget, n_events))
+            staged_bytes = chunk_events * staged_event_bytes
+            n_blocks = min(-(-chunk_events // block_dim[0]), max_blocks)
+
+        n_chunks = -(-n_events // chunk_events)
+        device_bytes = staged_bytes + n_copies * hist_bytes
+        if accumulation == 'sparse':
+            device_bytes += chunk_events * 4
+        elif n_copies > 1:
+            device_bytes += hist_bytes
+        return MemoryPlan(memory_budget, kernel_memory, accumulation,
+                          n_copies, block_dim, (n_blocks, 1), chunk_events,
+                          n_chunks, device_bytes)
+
+    def _grid_dim(self, n_elements, block_dim, plan):
+        """Grid for `n_elements` elements but at most as many blocks as the
+        plan allows"""
+        dx, mx = divmod(int(n_elements), block_dim[0])
+        return (max(min(dx + (mx>0), plan.grid_dim[0]), 1), 1)
+
+    def _iter_chunks(self, sample, n_events, event_bytes, plan,
+                     transform=None):
+        """Yield the chunks of a sample given by `plan` on the device
+        together with their number of events and their first event.
+        `transform` is called with each chunk and its number of events and
+        returns the chunk to yield instead."""
+        if transform is not None:
+            for d_chunk, chunk_events, start in self._iter_chunks(
+                    sample, n_events, event_bytes, plan):
+                yield transform(d_chunk, chunk_events), chunk_events, start
+            return
+        if isinstance(sample, cuda.DeviceAllocation):
+            if plan.n_chunks == 1:
+                yield sample, n_events, 0
+                return
+            for start in range(0, n_events, plan.chunk_events):
+                stop = min(start + plan.chunk_events, n_events)
+                yield (np.uintp(int(sample) + start*event_bytes),
+                       stop - start, start)
+        else:
+            d_chunk = cuda.mem_alloc(
+                max(min(plan.chunk_events, n_events) * event_bytes, 1))
+            for start in range(0, n_events, plan.chunk_events):
+                stop = min(start + plan.chunk_events, n_events)
+                cuda.memcpy_htod(d_chunk, sample[start:stop])
+                yield d_chunk, stop - start, start
+            d_chunk.free()
+
     def clear(self):
-        """Clear the histogram bins on the GPU"""
-        self.hist = np.zeros(self.n_flat_bins, dtype=self.HIST_TYPE)
-        cuda.memcpy_htod(self.d_hist, self.hist)
+        """Clear the histogram of the last fill of the calling thread"""
+        if self.hist is not None:
+            self.hist = np.zeros_like(self.hist)
 
 
+    @_in_context
     def get_hist(self, sample, shared=True, bins=10, normed=False,
-                 weights=None, dims=1, number_of_events=0):
+                 weights=None, dims=1, number_of_events=0, density=None,
+                 out_of_range='drop', return_stats=False, sample_dtype=None,
+                 memory_budget=None, auto_edges='linear', selection=None,
+                 transforms=None):
         """Retrive histogram with given events and edges
 
         Parameters
         ----------
-        bins: If edges, than with the rightmost edge!
+        bins: If edges, than with the rightmost edge! Each dimension may have
+            its own number of bins and non-uniform edges.
         dims: If a device array is given, provide the number of dims
+        sample_dtype: Type of a device array given as sample (default is
+            ftype). Host arrays are used with their own type. All types in
+            `SAMPLE_TYPES` are histogrammed without converting the sample;
+            integers in dimensions with bins of unit width are binned without
+            any floating point arithmetic.
+        normed: Same as density (like numpy's deprecated argument)
+        density: If True, return the probability density function at each
+            bin like `np.histogramdd(..., density=True)`. Bin volumes are
+            cached per set of edges.
+        out_of_range: How to handle events with values outside of the edges:
+            'drop' ignores them (like numpy), 'clamp' puts the values into the
+            first or last bin of their dimension and 'count' drops them but
+            counts them in dedicated underflow and overflow slots per
+            dimension. Values which are NaN always drop their event.
+        return_stats: If True (implied by out_of_range='count'), also return
+            the counts collected while binning as a dict with keys
+            'underflow' and 'overflow' (number of values per dimension, inf
+            included) as well as 'nan' and 'inf' (number of events with at
+            least one such value).
+        memory_budget: Bytes of device memory the histogram may use (default
+            is the budget given at construction). See `plan_memory`; the
+            chosen plan is stored as `memory_plan`.
+        auto_edges: How edges are found if only the number of bins is given:
+            'linear' spreads them evenly between the minimum and maximum and
+            'quantile' puts about the same number of events into each bin
+            (coinciding edges are merged). The quantiles are estimated with a
+            `QuantileSketch` per dimension while the range is reduced; the
+            sketches are stored as `sketches`.
+        selection: Only fill the selected events, given as a boolean mask,
+            an index array or a `Selection` (packed bitmask). The selection
+            is applied while binning, so no subset of the sample is copied.
+            A list or tuple whose elements are arrays, lists or `Selection`s
+            (or a 2d mask) fills one histogram per selection in one pass;
+            they are stacked along the first axis. Any other list, e.g. of
+            indices or bools, is converted with `np.asarray` and is one
+            selection.
+            Automatic edges are found from all events, so all selections
+            share them. Not supported together with stats.
+        transforms: Derived variables to histogram instead of the columns
+            of the sample, one `Transform` (or column number) per dimension.
+            They are computed on the device for each chunk before binning.
+            `bins` then refers to the dimensions of the histogram while
+            `dims` is still the number of columns of a device array.
 
         Returns
         -------
+        hist, edges and the stats if requested
 
         """
         t0 = time.time()
@@ -137,28 +1653,77 @@ class GPUHist(object):
             if number_of_events > 0:
                 n_dims = dims
                 n_events = number_of_events
+                if sample_dtype is None:
+                    sample_dtype = self.FTYPE
             else:
                 raise ValueError("If you use a device array as input, you have "
                 "to specify the number of events in your input and the number "
                 "of dims (default is 1 for dims).\n\n")
         else:
+            sample = np.asarray(sample)
             try:
                 n_events, n_dims = sample.shape
             except (AttributeError, ValueError):
                 sample = np.atleast_2d(sample).T
                 n_events, n_dims = sample.shape
             n_dims = self.ITYPE(n_dims)
+            sample = np.ascontiguousarray(sample)
+            sample_dtype = sample.dtype
+        if transforms is not None:
+            # The columns are read by the transform kernel, the binning
+            # kernels read the derived variables
+            n_columns = n_dims
+            raw_dtype = np.dtype(sample_dtype)
+            n_dims = self.ITYPE(len(transforms))
+            sample_dtype = np.dtype(self.FTYPE)
+            transform_info, transform_params = Transform.to_arrays(
+                transforms, n_columns, ftype=self.FTYPE)
+        kernels = self.get_kernels(sample_dtype)
+
+        if density is None:
+            density = normed
+        if out_of_range not in OUT_OF_RANGE_MODES:
+            raise ValueError('`out_of_range` must be one of %s. Got %s instead.'
+                             % (sorted(OUT_OF_RANGE_MODES), out_of_range))
+        flow_mode = self.ITYPE(OUT_OF_RANGE_MODES[out_of_range])
+        if auto_edges not in AUTO_EDGES:
+            raise ValueError('`auto_edges` must be one of %s. Got %s instead.'
+                             % (AUTO_EDGES, auto_edges))
+        return_stats = return_stats or out_of_range == 'count'
+        # Underflow and overflow for each dimension, NaN and inf
+        n_flow = 2*n_dims + 2 if return_stats else 0
+
+        selections = None
+        if selection is not None:
+            if return_stats:
+                raise ValueError('Stats and out-of-range counts are not '
+                                 'available for selections')
+            # Lists of plain numbers or bools are one index array or mask
+            several = isinstance(selection, (list, tuple)) and \
+                len(selection) > 0 and all(
+                    isinstance(s, (Selection, np.ndarray, list, tuple))
+                    for s in selection)
+            if not several and not isinstance(selection, Selection):
+                selection = np.asarray(selection)
+                several = selection.ndim == 2
+            if not several:
+                selection = [selection]
+            selections = [Selection.from_array(s, n_events)
+                          for s in selection]
+            n_selections = len(selections)
+            # Selections are filled with global memory atomics
+            shared = False
+        else:
+            n_selections = 1
 
         edges = None
+        edge_set = None
         bins_per_dimension = None
-        n_edges = None
-        d_edges_in = None
         d_max_in = None
         d_min_in = None
 
         sizeof_hist_t = np.dtype(self.HIST_TYPE).itemsize
         sizeof_c_ftype = np.dtype(self.C_FTYPE).itemsize
-        sizeof_float_t = np.dtype(self.FTYPE).itemsize
 
         # Check if number of bins for all dims is given or
         # if number of bins for each dimension is given or
@@ -167,174 +1732,308 @@ class GPUHist(object):
             #print '`bins` is int:', bins
             no_of_bins = self.ITYPE(bins)
             #print 'no_of_bins:', no_of_bins, 'n_dims:', n_dims
-            self.n_flat_bins = self.ITYPE(no_of_bins ** n_dims)
+            n_flat_bins = self.ITYPE(no_of_bins ** n_dims)
         elif isinstance(bins[0], (Iterable, np.ndarray)):
             #print '`bins` is sequence of sequence(s)'
-            self.n_flat_bins = 1
-            for i in range(len(bins)):
-                self.n_flat_bins = self.n_flat_bins * (len(bins[i]) - 1)
-            self.n_flat_bins = self.ITYPE(self.n_flat_bins)
-            no_of_bins = self.ITYPE(len(bins[0])-1)
-            edges = bins
-            n_edges = sum(sum(1 for i in b if i) for b in bins)
+            if len(bins) != n_dims:
+                raise ValueError('Got edges for %d dimensions but the sample '
+                                 'has %d dimensions' % (len(bins), n_dims))
+            edge_set = self.get_edge_set(bins)
+            n_flat_bins = self.ITYPE(edge_set.n_flat_bins)
+            no_of_bins = self.ITYPE(edge_set.n_bins[0])
+            edges = edge_set.edges
         else:
             #print '`bins` is neither int nor sequence of sequence(s)'
-            self.n_flat_bins = 1
-            for i in range(len(bins)):
-                self.n_flat_bins = self.n_flat_bins * bins[0]
-            bins_per_dimension = bins
-
-        # We use a one-dimensional block and grid.
-        # We use as many threads per block as possible but we are limited
-        # to the shared memory.
-        no_of_threads = (self.shared_memory / sizeof_c_ftype * 2)
-        if no_of_threads > self.max_threads_per_block:
-            overflow = self.max_threads_per_block%n_dims
-            self.block_dim = (self.max_threads_per_block-overflow, 1, 1)
-        else:
-            overflow = no_of_threads%n_dims
-            self.block_dim = (no_of_threads-overflow, 1, 1)
-        # debug
-        # overflow = 4%n_dims
-        # self.block_dim = (4-overflow, 1, 1)
+            if len(bins) != n_dims:
+                raise ValueError('Got bins for %d dimensions but the sample '
+                                 'has %d dimensions' % (len(bins), n_dims))
+            bins_per_dimension = [int(b) for b in bins]
+            n_flat_bins = self.ITYPE(np.prod(bins_per_dimension))
+            no_of_bins = self.ITYPE(bins_per_dimension[0])
 
-        self.hist = np.zeros(self.n_flat_bins, dtype=self.HIST_TYPE)
-        self.d_hist = cuda.mem_alloc(self.n_flat_bins * sizeof_hist_t)
+        # The counters for out-of-range values are accumulated as additional
+        # bins after the histogram. The histograms of several selections
+        # follow each other.
+        histo_length = n_selections*n_flat_bins + n_flow
 
-        # Define shared memory for max- and min-reduction
-        self.shared = (self.block_dim[0] * sizeof_c_ftype * 2)
-
-        # Check if shared memory can be used
-        if shared and self.n_flat_bins*sizeof_hist_t > self.shared_memory:
-            shared = False
+        sample_on_device = isinstance(sample, cuda.DeviceAllocation)
+        event_bytes = n_dims * np.dtype(sample_dtype).itemsize
+        sample_itemsize = np.dtype(sample_dtype).itemsize
+        buffer_bytes = 0
+        if transforms is not None:
+            # Each chunk is read with its columns and transformed into
+            # `d_transformed`, which device samples need as well. The
+            # transform is a pass of its own rather than fused into the
+            # binning: the range reduction, the sketches and every binning
+            # kernel read the same derived chunk.
+            event_bytes = n_columns * raw_dtype.itemsize
+            buffer_bytes = n_dims * sizeof_c_ftype
+        plan = self.plan_memory(n_events, n_dims, histo_length,
+                                sample_itemsize,
+                                sample_on_device=sample_on_device,
+                                shared=shared, memory_budget=memory_budget,
+                                event_bytes=event_bytes,
+                                buffer_bytes=buffer_bytes)
+        self.memory_plan = plan
+        block_dim = plan.block_dim
+        if shared and plan.kernel_memory != 'shared':
             sys.stderr.write(
                 "Not enough shared memory available; switching to global memory. "
                 "(n_flat_bins=%d, sizeof_hist_t=%d bytes)\n"
-                % (self.n_flat_bins, sizeof_hist_t)
+                % (n_flat_bins, sizeof_hist_t)
             )
+        if plan.accumulation != 'private' or plan.n_chunks > 1:
+            sys.stderr.write("%s\n" % plan)
+        shared = plan.kernel_memory == 'shared'
 
-        # Copy the arrays
-        if isinstance(sample, cuda.DeviceAllocation):
-            d_sample = sample
-        else:
-            d_sample = cuda.mem_alloc(sample.nbytes)
-            cuda.memcpy_htod(d_sample, sample)
-
-        # Calculate the number of blocks needed
-        dx, mx = divmod(n_events, self.block_dim[0])
-        self.grid_dim = ( (dx + (mx>0)), 1 )
+        transform = None
+        d_transformed = None
+        if transforms is not None:
+            transform_kernel = self.get_kernels(raw_dtype)['transform_columns']
+            d_transform_info = cuda.to_device(transform_info)
+            d_transform_params = cuda.to_device(transform_params)
+            d_transformed = cuda.mem_alloc(max(
+                min(plan.chunk_events, n_events) * n_dims * sizeof_c_ftype, 1))
+            def transform(d_chunk, chunk_events):
+                transform_kernel(d_chunk, self.HIST_TYPE(chunk_events),
+                        self.ITYPE(n_columns), self.ITYPE(n_dims),
+                        d_transform_info, d_transform_params, d_transformed,
+                        block=block_dim,
+                        grid=self._grid_dim(chunk_events, block_dim,
+                                            plan))
+                return d_transformed
 
-        # Allocate local histograms on device
-        try:
-            d_tmp_hist = cuda.mem_alloc(
-                self.n_flat_bins
-                * self.grid_dim[0]
-                * sizeof_hist_t
-            )
-        except pycuda._driver.MemoryError:
-            print self.n_flat_bins, self.grid_dim[0], sizeof_hist_t
-            raise
-
-        if shared:
-            # Calculate edges by yourself if no edges are given
-            if edges is None and bins_per_dimension is None:
-                d_max_in = cuda.mem_alloc(n_dims * sizeof_float_t)
-                d_min_in = cuda.mem_alloc(n_dims * sizeof_float_t)
-                self.max_min_reduce(d_sample,
-                        self.HIST_TYPE(n_events),
+        # Calculate edges by yourself if no edges are given
+        if edges is None:
+            d_max_in = cuda.to_device(np.full(n_dims, -np.inf, dtype=self.FTYPE))
+            d_min_in = cuda.to_device(np.full(n_dims, np.inf, dtype=self.FTYPE))
+            # The reduction needs a power of two threads per block
+            reduce_block = (1 << (int(block_dim[0]).bit_length() - 1), 1, 1)
+            shared_bytes = (reduce_block[0] * sizeof_c_ftype * 2)
+            if auto_edges == 'quantile':
+                sketches = [QuantileSketch() for d in range(n_dims)]
+                self.sketches = sketches
+                if sample_on_device or transform is not None:
+                    host_chunk = np.empty((min(plan.chunk_events, n_events),
+                                           n_dims), dtype=sample_dtype)
+            for d_chunk, chunk_events, start in self._iter_chunks(
+                    sample, n_events, event_bytes, plan,
+                    transform=transform):
+                kernels['max_min_reduce'](d_chunk,
+                        self.HIST_TYPE(chunk_events),
                         self.HIST_TYPE(n_dims), d_max_in, d_min_in,
-                        block=self.block_dim, grid=self.grid_dim,
-                        shared=self.shared)
+                        block=reduce_block,
+                        grid=self._grid_dim(chunk_events, reduce_block, plan),
+                        shared=shared_bytes)
+                if auto_edges == 'quantile':
+                    # Device and transformed samples are sketched on the
+                    # host, too
+                    if sample_on_device or transform is not None:
+                        chunk = host_chunk[:chunk_events]
+                        cuda.memcpy_dtoh(chunk, int(d_chunk))
+                    else:
+                        chunk = sample[start:start+chunk_events]
+                    for d in range(n_dims):
+                        sketches[d].update(chunk[:, d])
+            max_in = np.zeros(n_dims, dtype=self.FTYPE)
+            min_in = np.zeros(n_dims, dtype=self.FTYPE)
+            cuda.memcpy_dtoh(max_in, d_max_in)
+            cuda.memcpy_dtoh(min_in, d_min_in)
+            # Columns without any finite value get the range of
+            # `_host_edges`; the uniform kernels read it from the device
+            no_range = ~(min_in <= max_in)
+            # Constant columns are widened like in `_host_edges`, since
+            # edges must increase
+            constant = min_in == max_in
+            if np.any(no_range) or np.any(constant):
+                min_in[no_range] = 0
+                max_in[no_range] = 1
+                min_in[constant] -= 0.5
+                max_in[constant] += 0.5
+                cuda.memcpy_htod(d_max_in, max_in)
+                cuda.memcpy_htod(d_min_in, min_in)
+            if bins_per_dimension is None:
+                n_bins_per_dim = [no_of_bins] * n_dims
+            else:
+                n_bins_per_dim = bins_per_dimension
+            if auto_edges == 'quantile':
+                # Equal population edges use the non-uniform binning
+                edge_set = self.get_edge_set([
+                    sketches[d].edges(n_bins_per_dim[d], dtype=self.FTYPE)
+                    for d in range(n_dims)])
+            elif bins_per_dimension is not None or selections is not None:
+                # Bin with the edges kernels if the number of bins differs
+                # or for selections
+                edge_set = self.get_edge_set([
+                    np.linspace(min_in[d], max_in[d], n_bins_per_dim[d]+1,
+                                dtype=self.FTYPE)
+                    for d in range(n_dims)])
+            if edge_set is not None:
+                edges = edge_set.edges
+                # Coinciding quantiles may have been merged
+                n_flat_bins = self.ITYPE(edge_set.n_flat_bins)
+                histo_length = n_selections*n_flat_bins + n_flow
+
+        if edge_set is not None:
+            edge_args = edge_set.to_device(self.ITYPE)
+        hist = np.zeros(histo_length, dtype=self.HIST_TYPE)
+        if selections is not None:
+            mask_bytes = (n_events + 7) // 8
+            masks = np.empty((n_selections, mask_bytes), dtype=np.uint8)
+            for i, s in enumerate(selections):
+                masks[i] = s.bits
+
+        if plan.accumulation == 'sparse':
+            # Not even one histogram fits into the budget: keep only the flat
+            # bin of each event on the device and count them on the host.
+            if n_flow > 0:
+                d_flow = cuda.to_device(np.zeros(n_flow, dtype=self.HIST_TYPE))
+            else:
+                d_flow = np.intp(0)
+            d_bins_out = cuda.mem_alloc(plan.chunk_events * 4)
+            bins_out = np.empty(plan.chunk_events, dtype=np.int32)
+            for d_chunk, chunk_events, start in self._iter_chunks(
+                    sample, n_events, event_bytes, plan,
+                    transform=transform):
+                grid_dim = self._grid_dim(chunk_events, block_dim, plan)
+                if edge_set is None:
+                    kernels['flat_bins'](d_chunk,
+                            self.HIST_TYPE(chunk_events*n_dims),
+                            self.HIST_TYPE(n_dims),
+                            self.HIST_TYPE(no_of_bins), d_bins_out,
+                            d_max_in, d_min_in, flow_mode, d_flow,
+                            block=block_dim, grid=grid_dim)
+                else:
+                    args = ((d_chunk,
+                             self.HIST_TYPE(chunk_events*n_dims),
+                             self.HIST_TYPE(n_dims), d_bins_out)
+                            + edge_args + (flow_mode, d_flow))
+                    kernels['flat_bins_given_edges'](*args,
+                            block=block_dim, grid=grid_dim)
+                chunk_bins = bins_out[:chunk_events]
+                cuda.memcpy_dtoh(chunk_bins, d_bins_out)
+                if selections is None:
+                    selected_bins = [chunk_bins]
+                else:
+                    selected_bins = [
+                        chunk_bins[s.mask(start, start+chunk_events)]
+                        for s in selections]
+                for i, bins_i in enumerate(selected_bins):
+                    # Dropped events have a negative bin
+                    bins_i = bins_i[bins_i >= 0]
+                    found_bins, counts = np.unique(bins_i, return_counts=True)
+                    hist[i*n_flat_bins + found_bins] += \
+                        counts.astype(self.HIST_TYPE)
+            d_bins_out.free()
+            if n_flow > 0:
+                cuda.memcpy_dtoh(hist[n_flat_bins:], d_flow)
+                d_flow.free()
+
+        else:
+            # Allocate local histograms on device. Blocks share the copies
+            # if there are less copies than blocks, so they accumulate over
+            # all chunks. Copies which no block would touch are neither
+            # allocated nor merged.
+            n_copies = self.ITYPE(min(plan.n_copies, self._grid_dim(
+                min(plan.chunk_events, n_events), block_dim, plan)[0]))
+            try:
+                d_tmp_hist = cuda.mem_alloc(
+                    histo_length
+                    * n_copies
+                    * sizeof_hist_t
+                )
+            except pycuda._driver.MemoryError:
+                sys.stderr.write("%s\n" % plan)
+                raise
+            cuda.memset_d32(d_tmp_hist, 0, histo_length * n_copies)
+            if shared:
                 # Calculate local histograms on shared memory on device
-                self.shared = (self.n_flat_bins * sizeof_hist_t)
-                self.hist_smem(d_sample,
-                        self.HIST_TYPE(n_events*n_dims),
-                        self.HIST_TYPE(n_dims),
-                        self.HIST_TYPE(no_of_bins),
-                        self.HIST_TYPE(self.n_flat_bins), d_tmp_hist,
-                        d_max_in, d_min_in,
-                        block=self.block_dim, grid=self.grid_dim,
-                        shared=self.shared)
-
-            elif bins_per_dimension is None:
-                self.shared = (self.n_flat_bins * sizeof_hist_t)
-                d_edges_in = cuda.mem_alloc(n_edges * sizeof_float_t)
-                cuda.memcpy_htod(d_edges_in, edges)
-                self.hist_smem_given_edges(d_sample,
-                        self.HIST_TYPE(n_events*n_dims),
-                        self.HIST_TYPE(n_dims),
-                        self.HIST_TYPE(no_of_bins),
-                        self.HIST_TYPE(self.n_flat_bins),
-                        d_tmp_hist, d_edges_in,
-                        block=self.block_dim, grid=self.grid_dim,
-                        shared=self.shared)
+                shared_bytes = (histo_length * sizeof_hist_t)
+            else:
+                shared_bytes = 0
+            if selections is not None:
+                d_masks = cuda.to_device(masks)
+
+            for d_chunk, chunk_events, start in self._iter_chunks(
+                    sample, n_events, event_bytes, plan,
+                    transform=transform):
+                grid_dim = self._grid_dim(chunk_events, block_dim, plan)
+                if selections is not None:
+                    # The masks are indexed by the event number in the
+                    # whole sample
+                    args = ((d_chunk,
+                             self.HIST_TYPE(chunk_events*n_dims),
+                             self.HIST_TYPE(n_dims),
+                             self.HIST_TYPE(n_flat_bins),
+                             d_tmp_hist)
+                            + edge_args
+                            + (flow_mode, d_masks, self.ITYPE(n_selections),
+                               self.HIST_TYPE(mask_bytes),
+                               self.HIST_TYPE(start), n_copies))
+                    kernels['hist_selected_given_edges'](*args,
+                            block=block_dim, grid=grid_dim)
+                elif edge_set is None:
+                    kernel = kernels['hist_smem' if shared else 'hist_gmem']
+                    kernel(d_chunk,
+                            self.HIST_TYPE(chunk_events*n_dims),
+                            self.HIST_TYPE(n_dims),
+                            self.HIST_TYPE(no_of_bins),
+                            self.HIST_TYPE(n_flat_bins), d_tmp_hist,
+                            d_max_in, d_min_in, flow_mode,
+                            self.ITYPE(n_flow > 0), n_copies,
+                            block=block_dim, grid=grid_dim,
+                            shared=shared_bytes)
+                else:
+                    kernel = kernels['hist_smem_given_edges' if shared
+                                     else 'hist_gmem_given_edges']
+                    args = ((d_chunk,
+                             self.HIST_TYPE(chunk_events*n_dims),
+                             self.HIST_TYPE(n_dims),
+                             self.HIST_TYPE(n_flat_bins),
+                             d_tmp_hist)
+                            + edge_args
+                            + (flow_mode, self.ITYPE(n_flow > 0), n_copies))
+                    kernel(*args, block=block_dim, grid=grid_dim,
+                           shared=shared_bytes)
                 # # Debug
-                # tmp_hist = np.zeros(self.n_flat_bins * self.grid_dim[0], dtype=self.HIST_TYPE)
+                # tmp_hist = np.zeros(n_flat_bins * n_copies, dtype=self.HIST_TYPE)
                 # cuda.memcpy_dtoh(tmp_hist, d_tmp_hist)
-                # tmp_hist = np.reshape(tmp_hist, (self.grid_dim[0], no_of_bins, no_of_bins))
                 # print np.sum(tmp_hist)
-                # print "tmp_hist:\n", tmp_hist
 
+            if n_copies > 1:
+                d_hist = cuda.mem_alloc(histo_length * sizeof_hist_t)
+                kernels['hist_accum'](d_tmp_hist, n_copies, d_hist,
+                        self.HIST_TYPE(no_of_bins), self.HIST_TYPE(histo_length),
+                        self.HIST_TYPE(n_dims),
+                        block=block_dim,
+                        grid=self._grid_dim(histo_length, block_dim, plan))
+                d_tmp_hist.free()
             else:
-                print "Different number of bins per dimension is not implemented"
+                # The only copy is the histogram itself
+                d_hist = d_tmp_hist
+            # Copy the array back
+            cuda.memcpy_dtoh(hist, d_hist)
+            d_hist.free()
+            if selections is not None:
+                d_masks.free()
 
+        # Make the right shape
+        n_hist_bins = n_selections*n_flat_bins
+        flow = hist[n_hist_bins:]
+        hist = hist[:n_hist_bins]
+        if edge_set is not None:
+            histo_shape = edge_set.n_bins
         else:
-            # Calculate edges by yourself if no edges are given
-            if edges is None and bins_per_dimension is None:
-                d_max_in = cuda.mem_alloc(n_dims * sizeof_float_t)
-                d_min_in = cuda.mem_alloc(n_dims * sizeof_float_t)
-                self.max_min_reduce(d_sample,
-                        self.HIST_TYPE(n_events),
-                        self.HIST_TYPE(n_dims), d_max_in, d_min_in,
-                        block=self.block_dim, grid=self.grid_dim,
-                        shared=self.shared)
-                self.hist_gmem(d_sample,
-                        self.HIST_TYPE(n_events*n_dims),
-                        self.HIST_TYPE(n_dims),
-                        self.HIST_TYPE(no_of_bins),
-                        self.HIST_TYPE(self.n_flat_bins), d_tmp_hist,
-                        d_max_in, d_min_in,
-                        block=self.block_dim, grid=self.grid_dim)
-                # Debug
-                # tmp_hist = np.zeros(self.n_flat_bins * self.grid_dim[0], dtype=self.HIST_TYPE)
-                # cuda.memcpy_dtoh(tmp_hist, self.d_tmp_hist)
-                # tmp_hist = np.reshape(tmp_hist, (self.grid_dim[0], no_of_bins, no_of_bins))
-                # print np.sum(tmp_hist)
-                # print "tmp_hist:\n", tmp_hist
-
-            elif bins_per_dimension is None:
-                d_edges_in = cuda.mem_alloc(n_edges * sizeof_float_t)
-                cuda.memcpy_htod(d_edges_in, edges)
-                self.hist_gmem_given_edges(d_sample,
-                        self.HIST_TYPE(n_events*n_dims),
-                        self.HIST_TYPE(n_dims),
-                        self.HIST_TYPE(no_of_bins),
-                        self.HIST_TYPE(self.n_flat_bins),
-                        d_tmp_hist, d_edges_in,
-                        block=self.block_dim, grid=self.grid_dim)
+            histo_shape = ()
+            for d in range(0, n_dims):
+                histo_shape += (no_of_bins, )
+        if selections is not None and several:
+            histo_shape = (n_selections, ) + tuple(histo_shape)
+        hist = np.reshape(hist, histo_shape)
 
-            else:
-                print "Different number of bins per dimension is not implemented"
-
-        self.hist_accum(d_tmp_hist, self.ITYPE(self.grid_dim[0]), self.d_hist,
-                self.HIST_TYPE(no_of_bins), self.HIST_TYPE(self.n_flat_bins),
-                self.HIST_TYPE(n_dims),
-                block=self.block_dim, grid=self.grid_dim)
-        # Copy the array back and make the right shape
-        cuda.memcpy_dtoh(self.hist, self.d_hist)
-        histo_shape = ()
-        for d in range(0, n_dims):
-            histo_shape += (no_of_bins, )
-        self.hist = np.reshape(self.hist, histo_shape)
-
-        if edges is None and bins_per_dimension is None:
-            # Calculate the found edges
-            max_in = np.zeros(n_dims, dtype=self.FTYPE)
-            min_in = np.zeros(n_dims, dtype=self.FTYPE)
-            cuda.memcpy_dtoh(max_in, d_max_in)
-            cuda.memcpy_dtoh(min_in, d_min_in)
+        if edges is None:
+            # Create some nice edges from the found range
             edges = []
-            # Create some nice edges
             for d in range(0, n_dims):
                 try:
                     edges_d = np.linspace(min_in[d], max_in[d], no_of_bins+1, dtype=self.FTYPE)
@@ -342,23 +2041,643 @@ class GPUHist(object):
                     print min_in[d], max_in[d], no_of_bins, self.FTYPE
                     raise
                 edges.append(edges_d)
-        elif edges is None:
-            print "Different number of bins per dimension is not implemented"
-
-        self.d_hist.free()
-        d_tmp_hist.free()
-        if not isinstance(sample, cuda.DeviceAllocation):
-            d_sample.free()
-        if d_edges_in is not None:
-            d_edges_in.free()
+            if density:
+                edge_set = self.get_edge_set(edges)
+
+        if density and edge_set is not None:
+            if selections is not None and several:
+                hist = np.array([edge_set.density(h) for h in hist])
+            else:
+                hist = edge_set.density(hist)
+
         if d_max_in is not None:
             d_max_in.free()
         if d_min_in is not None:
             d_min_in.free()
+        if d_transformed is not None:
+            d_transformed.free()
+            d_transform_info.free()
+            d_transform_params.free()
 
+        self.hist = hist
         self.calc_time = time.time() - t0
 
-        return self.hist, edges
+        if return_stats:
+            stats = {
+                'underflow': flow[:n_dims].copy(),
+                'overflow': flow[n_dims:2*n_dims].copy(),
+                'nan': int(flow[2*n_dims]),
+                'inf': int(flow[2*n_dims+1]),
+            }
+            return hist, edges, stats
+        return hist, edges
+
+    @_in_context
+    def make_plan(self, edges, dims=None, weighted=False, **kwargs):
+        """Return a `FillPlan` for many fills with the given edges"""
+        return FillPlan(self, edges, dims=dims, weighted=weighted, **kwargs)
+
+    def get_hist_approx(self, sample, bins=10, rate=0.01,
+                        target_precision=None, seed=None, **kwargs):
+        """Estimate a histogram from subsamples of the sample.
+
+        Parameters
+        ----------
+        sample: Array on the host (see `ApproxHist`)
+        bins: See `get_hist`
+        rate: Fraction of the events filled per round
+        target_precision: If given, more rounds are filled until the largest
+            uncertainty relative to the fullest bin is at most this value
+        seed: Seed for choosing the subsamples
+        kwargs: Further arguments of `get_hist`
+
+        Returns
+        -------
+        hist, edges and the uncertainty of each bin. The `ApproxHist` is
+        stored as `approx` and can be refined further.
+
+        """
+        approx = ApproxHist(self, sample, bins=bins, rate=rate, seed=seed,
+                            **kwargs)
+        approx.refine()
+        while target_precision is not None and not approx.complete and \
+                approx.precision > target_precision:
+            # The uncertainty falls about with the square root of the number
+            # of filled events
+            needed = approx.n_rounds * (
+                (approx.precision / target_precision)**2 - 1)
+            approx.refine(max(int(np.ceil(needed)), 1)
+                          if np.isfinite(needed) else 1)
+        self.approx = approx
+        return approx.hist, approx.edges, approx.sigma
+
+    def _host_edges(self, sample, bins):
+        """Edges for `bins` as in `get_hist` with the range of the finite
+        values of a host sample of shape (n_events, n_dims)"""
+        n_dims = sample.shape[1]
+        if isinstance(bins, Iterable) and \
+                isinstance(list(bins)[0], Iterable):
+            return bins
+        if not isinstance(bins, Iterable):
+            bins = [bins] * n_dims
+        edges = []
+        for d in range(n_dims):
+            column = sample[:, d]
+            finite = column[np.isfinite(column)]
+            if len(finite) == 0:
+                low, high = 0, 1
+            else:
+                low, high = finite.min(), finite.max()
+            if low == high:
+                low, high = low - 0.5, high + 0.5
+            edges.append(np.linspace(low, high, int(bins[d])+1,
+                                     dtype=self.FTYPE))
+        return edges
+
+    @_in_context
+    def get_hist_jagged(self, contents, offsets, bins=10, weights=None,
+                        weights_per=None, **kwargs):
+        """Histogram jagged data, i.e. a variable number of entries per event.
+
+        Parameters
+        ----------
+        contents: Array of shape (n_entries,) or (n_entries, n_dims) on the
+            host with the entries of all events one after another
+        offsets: Array of shape (n_events+1,); event e owns the entries from
+            offsets[e] to offsets[e+1]. Entries before offsets[0] and after
+            offsets[-1] are ignored, as for a slice of a larger array.
+        bins: Number of bins for all dimensions, a list with the number of
+            bins for each dimension or a list with the edges for each
+            dimension. Without weights all options of `get_hist` apply.
+        weights: None, one weight per event or one weight per entry. Weights
+            of events are applied to their entries while filling, so they
+            are never broadcast on the host.
+        weights_per: None, 'event' or 'entry'; needed if there are as many
+            events as entries but not one entry per event (see
+            `FillPlan.fill`)
+        kwargs: Further arguments of `get_hist`; weighted fills take
+            `out_of_range` ('drop' or 'clamp'), `density`, `shared` and
+            `deterministic` (see `FillPlan`).
+
+        Returns
+        -------
+        hist, edges (and the stats of unweighted fills if requested)
+
+        """
+        contents = np.asarray(contents)
+        if contents.ndim == 1:
+            contents = contents.reshape(-1, 1)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets.ndim != 1 or len(offsets) < 1:
+            raise ValueError('The offsets must be a 1d array with one more '
+                             'value than the number of events')
+        # Views of the entries of the events; nothing is copied
+        contents = contents[offsets[0]:offsets[-1]]
+        offsets = offsets - offsets[0]
+        if weights is None:
+            # Without weights the events do not matter
+            return self.get_hist(contents, bins=bins, **kwargs)
+
+        n_dims = contents.shape[1]
+        edges = self._host_edges(contents, bins)
+        plan = self.make_plan(edges, dims=n_dims, weighted=True,
+                              sample_dtype=contents.dtype, **kwargs)
+        try:
+            hist = plan.fill(contents, weights=weights, offsets=offsets,
+                             weights_per=weights_per)
+        finally:
+            plan.free()
+        return hist, plan.edges
+
+    @_in_context
+    def get_profile(self, sample, y, bins=10, weights=None,
+                    out_of_range='drop', dims=1, number_of_events=0,
+                    sample_dtype=None, memory_budget=None):
+        """Mean and variance of a target in the bins of a histogram.
+
+        The sum of the weights, of the target and of its square are filled
+        in one pass. They are summed around the mean of the target in each
+        chunk, and the chunks are merged with `Profile.merge`, so the
+        variance stays accurate for targets with a large mean.
+
+        Parameters
+        ----------
+        sample: Array of shape (n_events, n_dims) or a device array
+        y: Array of shape (n_events,) on the host with the target. Events
+            with a NaN target are skipped.
+        bins: Number of bins for all dimensions, a list with the number of
+            bins for each dimension or a list with the edges for each
+            dimension. Device arrays need edges.
+        weights: None or array of shape (n_events,) on the host
+        out_of_range: 'drop' or 'clamp'
+        dims, number_of_events, sample_dtype: For device arrays, see
+            `get_hist`
+        memory_budget: See `get_hist`
+
+        Returns
+        -------
+        mean, variance and edges. The `Profile` is stored as `profile`.
+
+        """
+        if out_of_range not in ('drop', 'clamp'):
+            raise ValueError("`out_of_range` must be 'drop' or 'clamp'. "
+                             "Got %s instead." % out_of_range)
+        if isinstance(sample, cuda.DeviceAllocation):
+            if number_of_events <= 0:
+                raise ValueError('`number_of_events` is needed for device '
+                                 'arrays')
+            n_events, n_dims = number_of_events, dims
+            if sample_dtype is None:
+                sample_dtype = self.FTYPE
+            edges = bins
+        else:
+            sample = np.asarray(sample)
+            if sample.ndim == 1:
+                sample = sample.reshape(-1, 1)
+            sample = np.ascontiguousarray(sample)
+            n_events, n_dims = sample.shape
+            sample_dtype = sample.dtype
+            edges = self._host_edges(sample, bins)
+        y = np.ascontiguousarray(y, dtype=self.FTYPE)
+        if len(y) != n_events:
+            raise ValueError('Got %d targets for %d events'
+                             % (len(y), n_events))
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=self.FTYPE)
+            if len(weights) != n_events:
+                raise ValueError('Got %d weights for %d events'
+                                 % (len(weights), n_events))
+        kernels = self.get_kernels(sample_dtype)
+        edge_set = self.get_edge_set(edges)
+        edge_args = edge_set.to_device(self.ITYPE)
+        n_flat_bins = edge_set.n_flat_bins
+        sizeof_ftype = np.dtype(self.FTYPE).itemsize
+
+        # The targets and weights are copied into buffers of one chunk, for
+        # samples on the device as well
+        event_bytes = n_dims * np.dtype(sample_dtype).itemsize
+        n_columns = 1 if weights is None else 2
+        plan = self.plan_memory(
+            n_events, n_dims,
+            -(-3 * n_flat_bins * sizeof_ftype
+              // np.dtype(self.HIST_TYPE).itemsize),
+            np.dtype(sample_dtype).itemsize,
+            sample_on_device=isinstance(sample, cuda.DeviceAllocation),
+            shared=False, memory_budget=memory_budget,
+            buffer_bytes=n_columns * sizeof_ftype)
+        if plan.accumulation == 'sparse':
+            raise MemoryError('A profile with %d bins does not fit into the '
+                              'memory budget' % n_flat_bins)
+        self.memory_plan = plan
+        chunk_events = min(plan.chunk_events, n_events)
+        d_y = cuda.mem_alloc(max(chunk_events * sizeof_ftype, 1))
+        d_weights = np.intp(0)
+        if weights is not None:
+            d_weights = cuda.mem_alloc(max(chunk_events * sizeof_ftype, 1))
+        sums = np.empty(3 * n_flat_bins, dtype=self.FTYPE)
+        d_sums = cuda.mem_alloc(sums.nbytes)
+
+        profile = None
+        for d_chunk, chunk_events, start in self._iter_chunks(
+                sample, n_events, event_bytes, plan):
+            y_chunk = y[start:start+chunk_events]
+            cuda.memcpy_htod(d_y, y_chunk)
+            if weights is not None:
+                cuda.memcpy_htod(d_weights,
+                                 weights[start:start+chunk_events])
+            finite = y_chunk[np.isfinite(y_chunk)]
+            shift = self.FTYPE(finite.mean() if len(finite) > 0 else 0)
+            cuda.memset_d8(d_sums, 0, sums.nbytes)
+            args = ((d_chunk, self.HIST_TYPE(chunk_events*n_dims),
+                     self.ITYPE(n_dims), d_y, d_weights, shift,
+                     self.ITYPE(n_flat_bins), d_sums)
+                    + edge_args
+                    + (self.ITYPE(OUT_OF_RANGE_MODES[out_of_range]),
+                       np.intp(0)))
+            kernels['hist_profile_given_edges'](*args,
+                    block=plan.block_dim,
+                    grid=self._grid_dim(chunk_events, plan.block_dim, plan))
+            cuda.memcpy_dtoh(sums, d_sums)
+            sums_w, sums_wdy, sums_wdy2 = [
+                np.reshape(part, edge_set.n_bins)
+                for part in np.split(sums, 3)]
+            chunk_profile = Profile.from_sums(sums_w, sums_wdy, sums_wdy2,
+                                              shift, edge_set.edges)
+            if profile is None:
+                profile = chunk_profile
+            else:
+                profile.merge(chunk_profile)
+        d_y.free()
+        d_sums.free()
+        if weights is not None:
+            d_weights.free()
+        if profile is None:
+            zeros = np.zeros(edge_set.n_bins)
+            profile = Profile(zeros, zeros, zeros, edge_set.edges)
+
+        self.profile = profile
+        return profile.mean, profile.variance, edge_set.edges
+
+    @_in_context
+    def get_hist_bootstrap(self, sample, bins=10, n_replicas=100, seed=0,
+                           out_of_range='drop', dims=1, number_of_events=0,
+                           sample_dtype=None, memory_budget=None):
+        """Bootstrap replicas of a histogram from one pass over the sample.
+
+        Each event is binned once and added to every replica with a
+        Poisson(1) weight. The weights are drawn in the kernel from a
+        counter-based generator keyed by the seed, the index of the event
+        and the replica, so no weight matrix is created and the replicas are
+        the same for any number of threads or chunks.
+
+        Parameters
+        ----------
+        sample: Array of shape (n_events, n_dims) or a device array
+        bins: Number of bins for all dimensions, a list with the number of
+            bins for each dimension or a list with the edges for each
+            dimension. Device arrays need edges.
+        n_replicas: int
+        seed: int; replicas with the same seed are identical
+        out_of_range: 'drop' or 'clamp'
+        dims, number_of_events, sample_dtype: For device arrays, see
+            `get_hist`
+        memory_budget: See `get_hist`
+
+        Returns
+        -------
+        Counts of shape (n_replicas,) + histogram shape and the edges
+
+        """
+        t0 = time.time()
+        if out_of_range not in ('drop', 'clamp'):
+            raise ValueError("`out_of_range` must be 'drop' or 'clamp'. "
+                             "Got %s instead." % out_of_range)
+        if isinstance(sample, cuda.DeviceAllocation):
+            if number_of_events <= 0:
+                raise ValueError('`number_of_events` is needed for device '
+                                 'arrays')
+            n_events, n_dims = number_of_events, dims
+            if sample_dtype is None:
+                sample_dtype = self.FTYPE
+            edges = bins
+        else:
+            sample = np.asarray(sample)
+            if sample.ndim == 1:
+                sample = sample.reshape(-1, 1)
+            sample = np.ascontiguousarray(sample)
+            n_events, n_dims = sample.shape
+            sample_dtype = sample.dtype
+            edges = self._host_edges(sample, bins)
+        kernels = self.get_kernels(sample_dtype)
+        edge_set = self.get_edge_set(edges)
+        edge_args = edge_set.to_device(self.ITYPE)
+        n_flat_bins = edge_set.n_flat_bins
+
+        histo_length = n_replicas * n_flat_bins
+        plan = self.plan_memory(n_events, n_dims, histo_length,
+                                np.dtype(sample_dtype).itemsize,
+                                sample_on_device=isinstance(
+                                    sample, cuda.DeviceAllocation),
+                                shared=False, memory_budget=memory_budget)
+        if plan.accumulation == 'sparse':
+            raise MemoryError('%d replicas do not fit into the memory '
+                              'budget:\n%s' % (n_replicas, plan))
+        self.memory_plan = plan
+        # Integer sums do not depend on the order of the atomic additions,
+        # so all blocks add to the same replicas
+        hist = np.zeros(histo_length, dtype=self.HIST_TYPE)
+        d_hist = cuda.to_device(hist)
+        event_bytes = n_dims * np.dtype(sample_dtype).itemsize
+        for d_chunk, chunk_events, start in self._iter_chunks(
+                sample, n_events, event_bytes, plan):
+            args = ((d_chunk, self.HIST_TYPE(chunk_events*n_dims),
+                     self.ITYPE(n_dims), self.ITYPE(n_flat_bins), d_hist)
+                    + edge_args
+                    + (self.ITYPE(OUT_OF_RANGE_MODES[out_of_range]),
+                       self.ITYPE(n_replicas), np.uint64(seed),
+                       np.uint64(start)))
+            kernels['hist_bootstrap_given_edges'](*args,
+                    block=plan.block_dim,
+                    grid=self._grid_dim(chunk_events, plan.block_dim, plan))
+        cuda.memcpy_dtoh(hist, d_hist)
+        d_hist.free()
+        self.calc_time = time.time() - t0
+        return (hist.reshape((n_replicas,) + tuple(edge_set.n_bins)),
+                edge_set.edges)
+
+    def _per_event(self, sample, edges, kernel, out_dtype, extra_args,
+                   extra_bytes, out_of_range, dims, number_of_events,
+                   sample_dtype, memory_budget):
+        """Run `kernel` (a `*_given_edges` kernel which writes one value of
+        `out_dtype` per event after its `extra_args`) over the sample in
+        chunks and return the values of all events"""
+        if out_of_range not in ('drop', 'clamp'):
+            raise ValueError("`out_of_range` must be 'drop' or 'clamp'. "
+                             "Got %s instead." % out_of_range)
+        if isinstance(sample, cuda.DeviceAllocation):
+            if number_of_events <= 0:
+                raise ValueError('`number_of_events` is needed for device '
+                                 'arrays')
+            n_events, n_dims = number_of_events, dims
+            if sample_dtype is None:
+                sample_dtype = self.FTYPE
+        else:
+            sample = np.asarray(sample)
+            if sample.ndim == 1:
+                sample = sample.reshape(-1, 1)
+            sample = np.ascontiguousarray(sample)
+            n_events, n_dims = sample.shape
+            sample_dtype = sample.dtype
+        edge_set = self.get_edge_set(edges)
+        if edge_set.n_dims != n_dims:
+            raise ValueError('Got edges for %d dimensions but the sample has '
+                             '%d dimensions' % (edge_set.n_dims, n_dims))
+        kernel = self.get_kernels(sample_dtype)[kernel]
+        edge_args = edge_set.to_device(self.ITYPE)
+        out_dtype = np.dtype(out_dtype)
+
+        # The output of each chunk is staged with it
+        event_bytes = n_dims * np.dtype(sample_dtype).itemsize
+        plan = self.plan_memory(
+            n_events, n_dims,
+            -(-extra_bytes // np.dtype(self.HIST_TYPE).itemsize),
+            np.dtype(sample_dtype).itemsize
+            + -(-out_dtype.itemsize // n_dims),
+            sample_on_device=isinstance(sample, cuda.DeviceAllocation),
+            shared=False, memory_budget=memory_budget)
+        if plan.accumulation == 'sparse':
+            raise MemoryError('The lookup table does not fit into the '
+                              'memory budget:\n%s' % plan)
+        self.memory_plan = plan
+        out = np.empty(n_events, dtype=out_dtype)
+        d_out = cuda.mem_alloc(
+            max(min(plan.chunk_events, n_events) * out_dtype.itemsize, 1))
+        for d_chunk, chunk_events, start in self._iter_chunks(
+                sample, n_events, event_bytes, plan):
+            args = ((d_chunk, self.HIST_TYPE(chunk_events*n_dims),
+                     self.ITYPE(n_dims)) + extra_args + (d_out,)
+                    + edge_args
+                    + (self.ITYPE(OUT_OF_RANGE_MODES[out_of_range]),
+                       np.intp(0)))
+            kernel(*args, block=plan.block_dim,
+                   grid=self._grid_dim(chunk_events, plan.block_dim, plan))
+            cuda.memcpy_dtoh(out[start:start+chunk_events], d_out)
+        d_out.free()
+        return out
+
+    @_in_context
+    def find_bins(self, sample, edges, out_of_range='drop', dims=1,
+                  number_of_events=0, sample_dtype=None, memory_budget=None):
+        """Flat bin of each event for the given edges, i.e. the inverse of
+        a fill. The events are binned like in `get_hist`; uniform edges take
+        one multiplication per value.
+
+        Parameters
+        ----------
+        sample: Array of shape (n_events, n_dims) or a device array
+        edges: Edges for each dimension, including the rightmost edge
+        out_of_range: 'drop' gives -1 for events outside of the edges or
+            with NaN, 'clamp' puts them into the first or last bin
+        dims, number_of_events, sample_dtype: For device arrays, see
+            `get_hist`
+        memory_budget: See `get_hist`
+
+        Returns
+        -------
+        int32 array with the flat bin of each event; `np.unravel_index`
+        with the shape of the histogram gives the bin in each dimension
+
+        """
+        return self._per_event(sample, edges, 'flat_bins_given_edges',
+                               np.int32, (), 0, out_of_range, dims,
+                               number_of_events, sample_dtype, memory_budget)
+
+    @_in_context
+    def lookup(self, sample, values, edges, default=0, out_of_range='drop',
+               dims=1, number_of_events=0, sample_dtype=None,
+               memory_budget=None):
+        """Value of the bin of each event in a histogram-shaped array, e.g.
+        a reweighting map or an efficiency table. The bins are found and the
+        values gathered on the device in one pass.
+
+        Parameters
+        ----------
+        sample: Array of shape (n_events, n_dims) or a device array
+        values: Array with the shape of the histogram
+        edges: Edges for each dimension, including the rightmost edge
+        default: Value for events which are dropped
+        out_of_range, dims, number_of_events, sample_dtype, memory_budget:
+            See `find_bins`
+
+        Returns
+        -------
+        Array of ftype with the value of each event
+
+        """
+        edge_set = self.get_edge_set(edges)
+        values = np.ascontiguousarray(values, dtype=self.FTYPE)
+        if values.shape != tuple(edge_set.n_bins):
+            raise ValueError('The values have the shape %s but the edges '
+                             'give a histogram of shape %s'
+                             % (values.shape, tuple(edge_set.n_bins)))
+        d_values = cuda.to_device(values.ravel())
+        try:
+            return self._per_event(sample, edges, 'lookup_given_edges',
+                                   self.FTYPE,
+                                   (d_values, self.FTYPE(default)),
+                                   values.nbytes, out_of_range, dims,
+                                   number_of_events, sample_dtype,
+                                   memory_budget)
+        finally:
+            d_values.free()
+
+    @_in_context
+    def fill_many(self, sample, specs, out_of_range='drop', dims=1,
+                  number_of_events=0, sample_dtype=None, memory_budget=None):
+        """Fill several histograms with one pass over the sample.
+
+        Each distinct pair of column and edges (an axis) is binned once per
+        event and the bin is shared by all histograms using that axis, so
+        the sample is read only once however many histograms are filled.
+        All histograms are filled with global memory atomics.
+
+        Parameters
+        ----------
+        sample: Array of shape (n_events, n_columns) or a device array
+        specs: Sequence of `HistSpec` or of (columns, edges) tuples
+        out_of_range: 'drop' or 'clamp' (see `get_hist`)
+        dims, number_of_events, sample_dtype: See `get_hist`; dims is the
+            number of columns of a device array
+        memory_budget: See `get_hist`
+
+        Returns
+        -------
+        List of (hist, edges) in the order of `specs`
+
+        """
+        t0 = time.time()
+
+        if isinstance(sample, cuda.DeviceAllocation):
+            if number_of_events <= 0:
+                raise ValueError("If you use a device array as input, you "
+                "have to specify the number of events in your input and the "
+                "number of columns (default is 1 for dims).\n\n")
+            n_columns = dims
+            n_events = number_of_events
+            if sample_dtype is None:
+                sample_dtype = self.FTYPE
+        else:
+            sample = np.ascontiguousarray(np.asarray(sample))
+            if sample.ndim == 1:
+                sample = sample[:, None]
+            n_events, n_columns = sample.shape
+            sample_dtype = sample.dtype
+        kernels = self.get_kernels(sample_dtype)
+        if out_of_range not in ('drop', 'clamp'):
+            raise ValueError("`out_of_range` must be 'drop' or 'clamp'. "
+                             "Got %s instead." % out_of_range)
+        flow_mode = self.ITYPE(OUT_OF_RANGE_MODES[out_of_range])
+
+        # Find the distinct axes and lay out the histograms
+        axes = {}
+        axis_column = []
+        axis_edges = []
+        spec_offsets = []
+        spec_info = []
+        n_counts = 0
+        n_weights = 0
+        specs = [spec if isinstance(spec, HistSpec) else HistSpec(*spec)
+                 for spec in specs]
+        for spec in specs:
+            spec_axes = []
+            for column, edges in zip(spec.columns, spec.edges):
+                if not 0 <= column < n_columns:
+                    raise ValueError('Column %d is not in the sample'
+                                     % column)
+                key = (column,) + EdgeSet.key([edges])
+                if key not in axes:
+                    axes[key] = len(axis_column)
+                    axis_column.append(column)
+                    axis_edges.append(edges)
+                spec_axes.append(axes[key])
+            if spec.weight_column is None:
+                weight_column = n_columns
+                offset = n_counts
+            else:
+                weight_column = spec.weight_column
+                if not 0 <= weight_column < n_columns:
+                    raise ValueError('Column %d is not in the sample'
+                                     % weight_column)
+                offset = n_weights
+            spec_offsets.append(len(spec_info))
+            spec_info += [len(spec_axes), weight_column, offset] + spec_axes
+            n_flat_bins = int(np.prod([len(e) - 1 for e in spec.edges]))
+            if spec.weight_column is None:
+                n_counts += n_flat_bins
+            else:
+                n_weights += n_flat_bins
+        if len(axis_column) > MAX_FILL_AXES:
+            raise ValueError('At most %d distinct axes can be filled at once'
+                             % MAX_FILL_AXES)
+        edge_set = self.get_edge_set(axis_edges)
+
+        sizeof_hist_t = np.dtype(self.HIST_TYPE).itemsize
+        sizeof_float_t = np.dtype(self.FTYPE).itemsize
+        histo_length = n_counts + -(-n_weights*sizeof_float_t // sizeof_hist_t)
+        plan = self.plan_memory(n_events, n_columns, histo_length,
+                                np.dtype(sample_dtype).itemsize,
+                                sample_on_device=isinstance(
+                                    sample, cuda.DeviceAllocation),
+                                shared=False, memory_budget=memory_budget)
+        if plan.accumulation == 'sparse':
+            raise MemoryError('The histograms do not fit into the memory '
+                              'budget:\n%s' % plan)
+        self.memory_plan = plan
+
+        counts = np.zeros(max(n_counts, 1), dtype=self.HIST_TYPE)
+        weights = np.zeros(max(n_weights, 1), dtype=self.FTYPE)
+        d_counts = cuda.to_device(counts)
+        d_weights = cuda.to_device(weights)
+        d_axis_column = cuda.to_device(np.asarray(axis_column,
+                                                  dtype=self.ITYPE))
+        d_spec_offsets = cuda.to_device(np.asarray(spec_offsets,
+                                                   dtype=self.ITYPE))
+        d_spec_info = cuda.to_device(np.asarray(spec_info, dtype=self.ITYPE))
+        event_bytes = n_columns * np.dtype(sample_dtype).itemsize
+        d_bins_in, d_edges_in, d_guide_in, d_guide_info, d_guide_scale, \
+            d_int_range = edge_set.to_device(self.ITYPE)
+        for d_chunk, chunk_events, start in self._iter_chunks(
+                sample, n_events, event_bytes, plan):
+            kernels['hist_multi'](d_chunk,
+                    self.HIST_TYPE(chunk_events*n_columns),
+                    self.ITYPE(n_columns), self.ITYPE(len(axis_column)),
+                    d_axis_column, d_bins_in, d_edges_in, d_guide_in,
+                    d_guide_info, d_guide_scale, d_int_range, flow_mode,
+                    self.ITYPE(len(specs)), d_spec_offsets, d_spec_info,
+                    d_counts, d_weights,
+                    block=plan.block_dim,
+                    grid=self._grid_dim(chunk_events, plan.block_dim, plan))
+        cuda.memcpy_dtoh(counts, d_counts)
+        cuda.memcpy_dtoh(weights, d_weights)
+        for d_array in (d_counts, d_weights, d_axis_column, d_spec_offsets,
+                        d_spec_info):
+            d_array.free()
+
+        results = []
+        for spec, info_offset in zip(specs, spec_offsets):
+            offset = spec_info[info_offset + 2]
+            shape = tuple(len(e) - 1 for e in spec.edges)
+            n_flat_bins = int(np.prod(shape))
+            if spec.weight_column is None:
+                hist = counts[offset:offset+n_flat_bins]
+            else:
+                hist = weights[offset:offset+n_flat_bins]
+            edges = [edge_set.edges[spec_info[info_offset + 3 + d]]
+                     for d in range(len(shape))]
+            results.append((hist.reshape(shape), edges))
+
+        self.calc_time = time.time() - t0
+        return results
 
     def set_variables(self, ftype):
         """This method sets some variables like ftype and should be called at
@@ -390,10 +2709,107 @@ class GPUHist(object):
         return
 
 
+# One histogrammer per ftype for `make_plan`; the lock makes sure that
+# concurrent first calls create only one (and thus one context)
+_histogrammers = {}
+_histogrammers_lock = threading.Lock()
+
+
+def make_plan(edges, ftype=FTYPE, dims=None, weighted=False, **kwargs):
+    """Return a `FillPlan` for the given edges; see `FillPlan` for the other
+    arguments. The `GPUHist` behind the plans is created once per ftype."""
+    with _histogrammers_lock:
+        if ftype not in _histogrammers:
+            _histogrammers[ftype] = GPUHist(ftype=ftype)
+        histogrammer = _histogrammers[ftype]
+    return histogrammer.make_plan(edges, dims=dims, weighted=weighted,
+                                  **kwargs)
+
+
 def test_GPUHist():
     """A small test which calculates a histogram"""
     pass
 
 
+def test_concurrent_fills(n_threads=8, n_fills=32, n_events=100000):
+    """Fill histograms with different binnings and sample types from
+    several threads which share one `GPUHist` and compare them with numpy"""
+    from multiprocessing.pool import ThreadPool
+    histogrammer = GPUHist()
+    rng = np.random.RandomState(0)
+    tasks = []
+    for i in range(n_fills):
+        n_dims = 1 + i % 3
+        # Integer values never fall onto the edges, so rounding does not
+        # matter. Single precision samples compile kernels concurrently.
+        sample = rng.randint(0, 10, size=(n_events, n_dims)).astype(
+            np.float32 if i % 4 == 3 else FTYPE)
+        if i % 2:
+            bins = 10
+        else:
+            bins = [np.arange(-0.5, 10, 1 + i % 3) for d in range(n_dims)]
+        tasks.append((sample, bins))
+
+    def fill(task):
+        sample, bins = task
+        hist, edges = histogrammer.get_hist(sample, bins=bins)
+        # Other threads must not replace the result of this thread
+        assert histogrammer.hist is hist
+        return hist, edges
+
+    pool = ThreadPool(n_threads)
+    try:
+        results = pool.map(fill, tasks)
+    finally:
+        pool.close()
+    for i, ((sample, bins), (hist, edges)) in enumerate(zip(tasks, results)):
+        expected, _ = np.histogramdd(sample, bins=edges)
+        if not np.array_equal(hist, expected):
+            raise AssertionError('Fill %d differs from numpy by %d entries'
+                                 % (i, np.abs(hist - expected).sum()))
+    sys.stderr.write('%d concurrent fills on %d threads agree with numpy\n'
+                     % (n_fills, n_threads))
+
+
+
+def test_nonfinite_range(n_events=10000):
+    """NaN and inf must not widen the automatic range, in single and
+    double precision"""
+    rng = np.random.RandomState(0)
+    for ftype in (np.float32, np.float64):
+        histogrammer = GPUHist(ftype=ftype)
+        sample = rng.uniform(5, 6, size=(n_events, 2)).astype(ftype)
+        sample[::7, 0] = np.nan
+        sample[::11, 1] = np.inf
+        sample[::13, 1] = -np.inf
+        hist, edges = histogrammer.get_hist(sample, bins=10)
+        for d in range(2):
+            finite = sample[:, d][np.isfinite(sample[:, d])]
+            assert np.isclose(edges[d][0], finite.min())
+            assert np.isclose(edges[d][-1], finite.max())
+        assert hist.sum() == np.all(np.isfinite(sample), axis=1).sum()
+    sys.stderr.write('Non-finite values are kept out of the range\n')
+
+
+def test_constant_column(n_events=1000):
+    """A constant column gets the range of numpy (widened by 0.5), also
+    for densities"""
+    histogrammer = GPUHist()
+    rng = np.random.RandomState(0)
+    sample = np.column_stack([rng.uniform(size=n_events),
+                              np.full(n_events, 3.)]).astype(FTYPE)
+    for density in (False, True):
+        hist, edges = histogrammer.get_hist(sample, bins=10, density=density)
+        expected, expected_edges = np.histogramdd(sample, bins=10,
+                                                  density=density)
+        for a, b in zip(edges, expected_edges):
+            assert np.allclose(a, b)
+        assert np.allclose(hist, expected)
+    sys.stderr.write('Constant columns are binned like numpy\n')
+
+
 if __name__ == '__main__':
     test_GPUHist()
+    test_concurrent_fills()
+    test_nonfinite_range()
+    test_constant_column()
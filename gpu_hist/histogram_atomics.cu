@@ -9,9 +9,18 @@
 #define iType %(c_itype)s
 #define uiType %(c_uitype)s
 #define changeType %(c_changetype)s
-// See ieee floating point specification
-#define CUDART_INF_F __ull_as_fType(0x7ff0000000000000ULL)
-#define CUDART_NEG_INF_F __ull_as_fType(0xfff0000000000000ULL)
+// Type of the input sample and one of SAMPLE_FLOAT, SAMPLE_HALF (IEEE half
+// precision stored as unsigned short) or SAMPLE_INTEGER
+#define sType %(c_stype)s
+#define %(c_sample_kind)s
+// See ieee floating point specification; the bit pattern depends on the
+// precision of fType
+#ifdef SINGLE_PRECISION
+#define CUDART_INF_F __int_as_float(0x7f800000)
+#else
+#define CUDART_INF_F __longlong_as_double(0x7ff0000000000000LL)
+#endif
+#define CUDART_NEG_INF_F (-CUDART_INF_F)
 
 __device__ fType __ull_as_fType(unsigned long long int a)
 {
@@ -61,7 +70,53 @@ __device__ fType atomicMinfType(fType *address, fType val)
     return __change_as_fType(old);
 }
 
-__global__ void max_min_reduce(const fType *d_array, const iType n_elements,
+// atomicAdd for doubles needs compute capability 6.0, so floating point
+// values are added with atomicCAS, too.
+__device__ fType atomicAddfType(fType *address, fType val)
+{
+    changeType* address_as_ull = (changeType*) address;
+    changeType old = *address_as_ull, assumed;
+    do
+    {
+        assumed = old;
+        old = atomicCAS(address_as_ull, assumed,
+            __fType_as_change(__change_as_fType(assumed) + val));
+    } while(assumed != old);
+    return __change_as_fType(old);
+}
+
+// Converts the bits of an IEEE half precision value to float
+__device__ float __half_bits_as_float(unsigned short int h)
+{
+    unsigned int sign = ((unsigned int)(h & 0x8000)) << 16;
+    unsigned int exponent = (h >> 10) & 0x1f;
+    unsigned int mantissa = h & 0x3ff;
+    if(exponent == 0x1f)
+    {
+        // inf and NaN
+        return __uint_as_float(sign | 0x7f800000 | (mantissa << 13));
+    }
+    if(exponent == 0)
+    {
+        // zero and subnormal numbers: mantissa * 2^-24
+        float val = mantissa * 5.9604644775390625e-8f;
+        return sign ? -val : val;
+    }
+    return __uint_as_float(sign | ((exponent + 112) << 23) | (mantissa << 13));
+}
+
+// Values are converted while they are read, so no converted copy of the
+// sample is ever needed.
+__device__ fType __sample_as_fType(const sType val)
+{
+#ifdef SAMPLE_HALF
+    return __half_bits_as_float(val);
+#else
+    return (fType)val;
+#endif
+}
+
+__global__ void max_min_reduce(const sType *d_array, const iType n_elements,
     const iType no_of_dimensions, fType *d_max, fType *d_min)
 {
     // First n_elements entries are used for max reduction the last
@@ -72,16 +127,10 @@ __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
     int tid = threadIdx.x;
     int gid = blockIdx.x * blockDim.x + tid;
 
-    // Init global max and min value. This is a separated loop to avoid
-    // race conditions.
-    for(int d = 0; d < no_of_dimensions; d++)
-    {
-        if(gid == 0)
-        {
-            d_max[d] = CUDART_NEG_INF_F;
-            d_min[d] = CUDART_INF_F;
-        }
-    }
+    // The global max and min values are initialized by the host, so that
+    // several launches (e.g. for chunks of a sample) can be reduced into
+    // them. Only finite values are reduced; inf and NaN end up in the
+    // out-of-range counters instead of stretching the range.
 
     // Max- and Min-Reduce for each dimension
     for(int d = 0; d < no_of_dimensions; d++)
@@ -89,8 +138,10 @@ __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
         // Initialize shared memory with input memory
         if(gid < n_elements)
         {
-            shared_max[tid] = d_array[gid*no_of_dimensions+d];
-            shared_min[tid] = d_array[gid*no_of_dimensions+d];
+            fType val = __sample_as_fType(d_array[gid*no_of_dimensions+d]);
+            bool finite = isfinite(val);
+            shared_max[tid] = finite ? val : CUDART_NEG_INF_F;
+            shared_min[tid] = finite ? val : CUDART_INF_F;
             gid += gridDim.x * blockDim.x;
         }
 
@@ -98,12 +149,14 @@ __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
         // If there are more elements than threads, then we copy the next
         // elements from input if they are bigger/lower than the last copied
         // values.
-        while(gid < n_elements && gid >= n_elements)
+        while(gid < n_elements)
         {
-            shared_max[tid] = max(shared_max[tid],
-                d_array[gid*no_of_dimensions+d]);
-            shared_min[tid] = min(shared_min[tid],
-                d_array[gid*no_of_dimensions+d]);
+            fType val = __sample_as_fType(d_array[gid*no_of_dimensions+d]);
+            if(isfinite(val))
+            {
+                shared_max[tid] = max(shared_max[tid], val);
+                shared_min[tid] = min(shared_min[tid], val);
+            }
             gid += gridDim.x * blockDim.x;
         }
         __syncthreads();
@@ -130,25 +183,297 @@ __global__ void max_min_reduce(const fType *d_array, const iType n_elements,
             atomicMaxfType(&d_max[d], shared_max[0]);
             atomicMinfType(&d_min[d], shared_min[0]);
         }
+        // Shared memory is reused for the next dimension
+        __syncthreads();
+    }
+}
+
+// Derived variables computed by transform_columns
+#define TRANSFORM_COLUMN 0
+#define TRANSFORM_LOG 1
+#define TRANSFORM_LOG10 2
+#define TRANSFORM_COS 3
+#define TRANSFORM_RATIO 4
+#define TRANSFORM_PRODUCT 5
+
+// Computes no_of_dimensions derived variables for each of the n_events
+// events of in, which have no_of_columns columns, and writes them to out as
+// a sample of type fType for the binning kernels. For dimension d,
+// transform_info[3*d] is one of the TRANSFORM_* codes and the next two
+// values are the column and, for ratios and products, the second column.
+// The result is then scaled and shifted with transform_params[4*d] and
+// transform_params[4*d+1] and clipped to [transform_params[4*d+2],
+// transform_params[4*d+3]]. NaN is never clipped, so it is still counted.
+__global__ void transform_columns(const sType *in, const iType n_events,
+        const iType no_of_columns, const iType no_of_dimensions,
+        const iType *transform_info, const fType *transform_params,
+        fType *out)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int e = gid; e < n_events; e += total_threads)
+    {
+        const sType *event = &in[e*no_of_columns];
+        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        {
+            const iType *info = &transform_info[3*d];
+            const fType *params = &transform_params[4*d];
+            fType val = __sample_as_fType(event[info[1]]);
+            switch(info[0])
+            {
+                case TRANSFORM_LOG: val = log(val); break;
+                case TRANSFORM_LOG10: val = log10(val); break;
+                case TRANSFORM_COS: val = cos(val); break;
+                case TRANSFORM_RATIO:
+                    val = val / __sample_as_fType(event[info[2]]); break;
+                case TRANSFORM_PRODUCT:
+                    val = val * __sample_as_fType(event[info[2]]); break;
+            }
+            val = params[0] * val + params[1];
+            if(val < params[2]) val = params[2];
+            if(val > params[3]) val = params[3];
+            out[e*no_of_dimensions + d] = val;
+        }
+    }
+}
+
+// Results of binning a single value besides a valid bin
+#define BIN_UNDERFLOW -1
+#define BIN_OVERFLOW -2
+#define BIN_NAN -3
+
+// Out-of-range handling: drop the event or clamp the value into the first or
+// last bin of its dimension
+#define FLOW_DROP 0
+#define FLOW_CLAMP 1
+
+// Returns the bin of val for no_of_bins equally sized bins between min_in and
+// max_in or one of the BIN_* codes.
+__device__ int find_bin_uniform(const fType val, const fType min_in,
+        const fType max_in, const iType no_of_bins)
+{
+    if(val < min_in) return BIN_UNDERFLOW;
+    if(val > max_in) return BIN_OVERFLOW;
+    if(val != val) return BIN_NAN;
+    fType bin_width = (max_in-min_in)/no_of_bins;
+    if(!(bin_width > 0)) return 0;
+    int tmp_bin = (val-min_in)/bin_width;
+    if(tmp_bin >= no_of_bins) tmp_bin = no_of_bins - 1;
+    return tmp_bin;
+}
+
+// Returns the bin of val within the given edges of one dimension or one of
+// the BIN_* codes. As in numpy all bins are half-open except for the last one
+// which includes the rightmost edge.
+// If guide_size > 0, guide is a table which divides the range of the edges
+// into guide_size cells of equal width and stores the bin at the start of
+// each cell. The cell of val is found with one multiplication and the bin is
+// fixed up with the edges within that cell (usually none or one).
+// Otherwise a branch-free binary search over the edges is used.
+__device__ int find_bin(const fType val, const fType *edges,
+        const iType n_bins, const iType *guide, const iType guide_size,
+        const fType guide_scale)
+{
+    if(val < edges[0]) return BIN_UNDERFLOW;
+    if(val > edges[n_bins]) return BIN_OVERFLOW;
+    if(val != val) return BIN_NAN;
+    int tmp_bin;
+    if(guide_size > 0)
+    {
+        int cell = min((int)((val - edges[0]) * guide_scale),
+                       (int)guide_size - 1);
+        tmp_bin = guide[cell];
+        // Rounding may place val in a neighbouring cell
+        while(tmp_bin > 0 && val < edges[tmp_bin])
+        {
+            tmp_bin--;
+        }
+        while(tmp_bin < n_bins-1 && val >= edges[tmp_bin+1])
+        {
+            tmp_bin++;
+        }
+    }
+    else
+    {
+        // Find the last edge <= val
+        const fType *base = edges;
+        unsigned int len = n_bins + 1;
+        while(len > 1)
+        {
+            unsigned int half = len / 2;
+            base = (base[half] <= val) ? base + half : base;
+            len -= half;
+        }
+        tmp_bin = min((int)(base - edges), (int)n_bins - 1);
+    }
+    return tmp_bin;
+}
+
+// Returns the bin of the integer val for bins of unit width or one of the
+// BIN_* codes. first is the smallest and last the largest integer within the
+// edges, so no floating point arithmetic is needed.
+__device__ int find_bin_integer(const long long int val,
+        const long long int first, const long long int last,
+        const iType n_bins)
+{
+    if(val < first) return BIN_UNDERFLOW;
+    if(val > last) return BIN_OVERFLOW;
+    // The rightmost edge belongs to the last bin
+    return (int)min(val - first, (long long int)n_bins - 1);
+}
+
+// Applies the out-of-range handling to the result tmp_bin of binning val in
+// dimension d. Returns the bin to use or -1 if the event has to be dropped.
+// If flow is not NULL, it points to 2*no_of_dimensions+2 counters: underflow
+// for each dimension, overflow for each dimension, events with NaN and events
+// with inf. The NaN and inf counters are only updated by count_nan_inf since
+// they count events and not values.
+__device__ int apply_flow(int tmp_bin, const bool val_is_inf,
+        const unsigned int d, const iType no_of_dimensions, const iType n_bins,
+        const iType flow_mode, uiType *flow, bool *has_nan, bool *has_inf)
+{
+    if(tmp_bin >= 0) return tmp_bin;
+    if(tmp_bin == BIN_NAN)
+    {
+        *has_nan = true;
+        return -1;
+    }
+    if(val_is_inf) *has_inf = true;
+    if(flow != NULL)
+    {
+        if(tmp_bin == BIN_UNDERFLOW) atomicAdd(&flow[d], 1);
+        else atomicAdd(&flow[no_of_dimensions + d], 1);
+    }
+    if(flow_mode == FLOW_CLAMP)
+    {
+        return (tmp_bin == BIN_UNDERFLOW) ? 0 : n_bins - 1;
+    }
+    return -1;
+}
+
+__device__ void count_nan_inf(const iType no_of_dimensions, uiType *flow,
+        const bool has_nan, const bool has_inf)
+{
+    if(flow == NULL) return;
+    if(has_nan) atomicAdd(&flow[2*no_of_dimensions], 1);
+    if(has_inf) atomicAdd(&flow[2*no_of_dimensions + 1], 1);
+}
+
+// Returns the flat (row-major) bin of the event starting at in or -1 if the
+// event is dropped. Each dimension has no_of_bins equally sized bins between
+// min_in and max_in.
+__device__ int find_flat_bin_uniform(const sType *in,
+        const iType no_of_dimensions, const iType no_of_bins,
+        const fType *max_in, const fType *min_in, const iType flow_mode,
+        uiType *flow)
+{
+    int current_bin = 0;
+    bool dropped = false;
+    bool has_nan = false;
+    bool has_inf = false;
+    for(unsigned int d = 0; d < no_of_dimensions; d++)
+    {
+        fType val = __sample_as_fType(in[d]);
+        int tmp_bin = apply_flow(
+            find_bin_uniform(val, min_in[d], max_in[d], no_of_bins),
+            isinf(val), d, no_of_dimensions, no_of_bins, flow_mode, flow,
+            &has_nan, &has_inf);
+        if(tmp_bin < 0) dropped = true;
+        current_bin = current_bin * no_of_bins + tmp_bin;
+    }
+    count_nan_inf(no_of_dimensions, flow, has_nan, has_inf);
+    return dropped ? -1 : current_bin;
+}
+
+// Returns the flat (row-major) bin of the event starting at in or -1 if the
+// event is dropped. bins_in holds the number of bins of each dimension and
+// edges_in the concatenated edges of all dimensions. guide_info holds the
+// offset of each dimension's guide table in guide_in followed by the sizes
+// of all guide tables. int_range holds the first and last integer within the
+// edges of each dimension if it has bins of unit width (otherwise first is
+// larger than last); it is only used for integer samples.
+__device__ int find_flat_bin_with_edges(const sType *in,
+        const iType no_of_dimensions, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode, uiType *flow)
+{
+    int current_bin = 0;
+    bool dropped = false;
+    bool has_nan = false;
+    bool has_inf = false;
+    const fType *edges = edges_in;
+    for(unsigned int d = 0; d < no_of_dimensions; d++)
+    {
+        int tmp_bin;
+        bool val_is_inf = false;
+#ifdef SAMPLE_INTEGER
+        if(int_range[2*d] <= int_range[2*d+1])
+        {
+            tmp_bin = find_bin_integer(in[d], int_range[2*d],
+                int_range[2*d+1], bins_in[d]);
+        }
+        else
+#endif
+        {
+            fType val = __sample_as_fType(in[d]);
+            val_is_inf = isinf(val);
+            tmp_bin = find_bin(val, edges, bins_in[d],
+                &guide_in[guide_info[d]], guide_info[no_of_dimensions+d],
+                guide_scale[d]);
+        }
+        tmp_bin = apply_flow(tmp_bin, val_is_inf, d, no_of_dimensions,
+            bins_in[d], flow_mode, flow, &has_nan, &has_inf);
+        if(tmp_bin < 0) dropped = true;
+        current_bin = current_bin * bins_in[d] + tmp_bin;
+        edges += bins_in[d] + 1;
+    }
+    count_nan_inf(no_of_dimensions, flow, has_nan, has_inf);
+    return dropped ? -1 : current_bin;
+}
+
+// All fill kernels add to n_copies partial histograms in out which have to be
+// zeroed by the host. If n_copies equals the number of blocks, each block
+// owns one partial histogram. Otherwise blocks share them (block i uses
+// partial histogram i %% n_copies) and all updates are atomic. Since the
+// partial histograms are only added to, a sample can be filled in chunks
+// with several launches. If count_flow is set, each partial histogram is
+// followed by the 2*no_of_dimensions+2 counters described at apply_flow.
+
+// Adds the histogram of a block in shared memory to its partial histogram in
+// global memory. Bins which are zero are skipped.
+__device__ void write_partial_histogram(const uiType *smem, uiType *out,
+        const unsigned int histo_length, const iType n_copies)
+{
+    uiType *gmem = &out[(blockIdx.x %% n_copies) * histo_length];
+    for(unsigned int i = threadIdx.x; i < histo_length;  i+= blockDim.x)
+    {
+        if(smem[i] == 0) continue;
+        if(n_copies < gridDim.x)
+        {
+            atomicAdd(&gmem[i], smem[i]);
+        }
+        else
+        {
+            gmem[i] += smem[i];
+        }
     }
 }
 
 // Takes max and min value for each dimension and the number of bins and
 // returns a histogram with equally sized bins.
-__global__ void histogram_gmem_atomics(const fType *in,  const iType length,
+__global__ void histogram_gmem_atomics(const sType *in,  const iType length,
         const iType no_of_dimensions,  const iType no_of_bins,
-        const iType no_of_flat_bins, uiType *out, fType *max_in, fType *min_in)
+        const iType no_of_flat_bins, uiType *out, fType *max_in, fType *min_in,
+        const iType flow_mode, const iType count_flow, const iType n_copies)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    // initialize temporary histogram for each block in global memory
-    uiType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i < no_of_flat_bins; i += blockDim.x)
-    {
-        gmem[i] = 0;
-    }
+    unsigned int histo_length = no_of_flat_bins
+        + (count_flow ? 2*no_of_dimensions + 2 : 0);
+    // temporary histogram of this block in global memory
+    uiType *gmem = out + histo_length * (blockIdx.x %% n_copies);
+    uiType *flow = count_flow ? &gmem[no_of_flat_bins] : NULL;
 
     // Process input data by updating the histogram of each block in global
     // memory. Each thread processes one element with all its dimensions at a
@@ -156,93 +481,68 @@ __global__ void histogram_gmem_atomics(const fType *in,  const iType length,
     for(unsigned int i = gid*no_of_dimensions; i < length;
         i+=no_of_dimensions*total_threads)
     {
-        int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
-        {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins;
-            fType val = in[i + d];
-            // Get the bin in the current dimension
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins) tmp_bin--;
-            // Get the right place in the histogram
-            int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
-            {
-                power_bins = no_of_bins * power_bins;
-            }
-            current_bin += tmp_bin * power_bins;
-        }
-        // Avoid illegal memory access
-        if(current_bin < no_of_flat_bins)
+        int current_bin = find_flat_bin_uniform(&in[i], no_of_dimensions,
+            no_of_bins, max_in, min_in, flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
         {
             atomicAdd(&gmem[current_bin], 1);
         }
     }
 }
 
-// Takes edges for each dimension and the number of bins and
-// returns a histogram with equally sized bins.
-__global__ void histogram_gmem_atomics_with_edges(const fType *in,
+// Takes the edges and lookup structures of all dimensions (see
+// find_flat_bin_with_edges) and returns a histogram with arbitrary bins.
+__global__ void histogram_gmem_atomics_with_edges(const sType *in,
         const iType length, const iType no_of_dimensions,
-        const iType no_of_bins, const iType no_of_flat_bins,
-        uiType *out, const fType *edges_in)
+        const iType no_of_flat_bins, uiType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode,
+        const iType count_flow, const iType n_copies)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
-    unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
+    unsigned int histo_length = no_of_flat_bins
+        + (count_flow ? 2*no_of_dimensions + 2 : 0);
 
-    // initialize temporary histogram for each block in global memory
-    uiType *gmem = out + no_of_flat_bins * blockIdx.x;
-    // Each thread writes zeros to global memory
-    for(unsigned int i = tid; i <no_of_flat_bins; i += blockDim.x)
-    {
-        gmem[i] = 0;
-    }
-    __syncthreads();
+    // temporary histogram of this block in global memory
+    uiType *gmem = out + histo_length * (blockIdx.x %% n_copies);
+    uiType *flow = count_flow ? &gmem[no_of_flat_bins] : NULL;
 
     // Process input data by updating the histogram of each block in global
     // memory.
     for(unsigned int i = gid * no_of_dimensions; i < length;
             i += no_of_dimensions * total_threads)
     {
-        int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
-        {
-            fType val = in[i + d];
-            int tmp_bin = 0;
-            while(val > edges_in[(no_of_bins+1)*d+tmp_bin+1] && tmp_bin < no_of_bins)
-            {
-                 tmp_bin++;
-            }
-            int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
-            {
-                power_bins = no_of_bins * power_bins;
-            }
-            current_bin += tmp_bin * power_bins;
-        }
-        __syncthreads();
-        // Avoid illegal memory access
-        if(current_bin < no_of_flat_bins)
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
         {
             atomicAdd(&gmem[current_bin], 1);
         }
     }
 }
 
-__global__ void histogram_smem_atomics(const fType *in,  const iType length,
+__global__ void histogram_smem_atomics(const sType *in,  const iType length,
         const iType no_of_dimensions,  const iType no_of_bins,
-        const iType no_of_flat_bins, uiType *out, fType *max_in, fType *min_in)
+        const iType no_of_flat_bins, uiType *out, fType *max_in, fType *min_in,
+        const iType flow_mode, const iType count_flow, const iType n_copies)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
     unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
     unsigned int threads_per_block = blockDim.x;
+    unsigned int histo_length = no_of_flat_bins
+        + (count_flow ? 2*no_of_dimensions + 2 : 0);
 
     // initialize temporary accumulation array in shared memory
     extern __shared__ uiType smem[];
     // __shared__ uiType smem[no_of_bins * no_of_dimensions]; <- this is the idea
-    for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
+    uiType *flow = count_flow ? &smem[no_of_flat_bins] : NULL;
+    for(unsigned int i = tid; i < histo_length;  i+= threads_per_block)
     {
         smem[i] = 0;
     }
@@ -254,50 +554,37 @@ __global__ void histogram_smem_atomics(const fType *in,  const iType length,
     for(unsigned int i = gid*no_of_dimensions; i < length;
         i+=no_of_dimensions*total_threads)
     {
-        int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
-        {
-            fType bin_width = (max_in[d]-min_in[d])/no_of_bins;
-            fType val = in[i + d];
-            // Get the bin in the current dimension
-            int tmp_bin = (val-min_in[d])/bin_width;
-            if(tmp_bin >= no_of_bins) tmp_bin--;
-            // Get the right place in the histogram
-            int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
-            {
-                power_bins = no_of_bins * power_bins;
-            }
-            current_bin += tmp_bin * power_bins;
-        }
-        // Avoid illegal memory access
-        if(current_bin < no_of_flat_bins)
+        int current_bin = find_flat_bin_uniform(&in[i], no_of_dimensions,
+            no_of_bins, max_in, min_in, flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
         {
             atomicAdd(&smem[current_bin], 1);
         }
     }
     __syncthreads();
-    // Write partial histograms in global memory
-    out = &out[blockIdx.x * no_of_flat_bins];
-    for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
-    {
-        out[i] = smem[i];
-    }
+    write_partial_histogram(smem, out, histo_length, n_copies);
 }
 
-__global__ void histogram_smem_atomics_with_edges(const fType *in,
+__global__ void histogram_smem_atomics_with_edges(const sType *in,
         const iType length, const iType no_of_dimensions,
-        const iType no_of_bins, const iType no_of_flat_bins,
-        uiType *out, const fType *edges_in)
+        const iType no_of_flat_bins, uiType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode,
+        const iType count_flow, const iType n_copies)
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
     unsigned int tid = threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
     unsigned int threads_per_block = blockDim.x;
+    unsigned int histo_length = no_of_flat_bins
+        + (count_flow ? 2*no_of_dimensions + 2 : 0);
 
     // initialize temporary accumulation array in shared memory
     extern __shared__ uiType smem[];
-    for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
+    uiType *flow = count_flow ? &smem[no_of_flat_bins] : NULL;
+    for(unsigned int i = tid; i < histo_length;  i+= threads_per_block)
     {
         smem[i] = 0;
     }
@@ -309,36 +596,418 @@ __global__ void histogram_smem_atomics_with_edges(const fType *in,
     for(unsigned int i = gid*no_of_dimensions; i < length;
         i+=no_of_dimensions*total_threads)
     {
-        int current_bin = 0;
-        for(unsigned int d = 0; d < no_of_dimensions; d++)
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
         {
-            fType val = in[i + d];
-            int tmp_bin = 0;
-            while(val > edges_in[(no_of_bins+1)*d+tmp_bin+1] && tmp_bin < no_of_bins)
+            atomicAdd(&smem[current_bin], 1);
+        }
+    }
+    __syncthreads();
+    write_partial_histogram(smem, out, histo_length, n_copies);
+}
+
+// Adds the weight of each event to its bin of a single histogram in global
+// memory which has to be zeroed by the host. Arguments as for
+// histogram_gmem_atomics_with_edges; flow may be NULL, otherwise the
+// counters described at apply_flow are updated.
+__global__ void histogram_gmem_weighted_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions,
+        const fType *weights, fType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
+        {
+            atomicAddfType(&out[current_bin], weights[i/no_of_dimensions]);
+        }
+    }
+}
+
+// Returns the event of entry j of jagged data, i.e. the last event e with
+// offsets[e] <= j. offsets holds n_events+1 ascending values starting at 0,
+// so empty events, which share their offset with the next event, are never
+// returned.
+__device__ unsigned int event_of_entry(const iType *offsets,
+        const iType n_events, const unsigned int j)
+{
+    unsigned int lo = 0;
+    unsigned int hi = n_events;
+    while(hi - lo > 1)
+    {
+        unsigned int mid = (lo + hi) / 2;
+        if(offsets[mid] <= j) lo = mid;
+        else hi = mid;
+    }
+    return lo;
+}
+
+// Like histogram_gmem_weighted_with_edges for jagged data: in holds the
+// entries of all events one after another and event e owns the entries from
+// offsets[e] to offsets[e+1]. Each entry is weighted with the weight of its
+// event, so the weights never have to be broadcast to the entries.
+__global__ void histogram_gmem_jagged_weighted_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions,
+        const iType *offsets, const iType n_events, const fType *weights,
+        fType *out, const iType *bins_in, const fType *edges_in,
+        const iType *guide_in, const iType *guide_info,
+        const fType *guide_scale, const long long int *int_range,
+        const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped entries
+        if(current_bin >= 0)
+        {
+            unsigned int e = event_of_entry(offsets, n_events,
+                                            i/no_of_dimensions);
+            atomicAddfType(&out[current_bin], weights[e]);
+        }
+    }
+}
+
+// Deterministic variant of histogram_gmem_weighted_with_edges and
+// histogram_gmem_jagged_weighted_with_edges. Each weight is converted to a
+// fixed-point integer, round(w * scale) with a power of two scale, and added
+// with 64 bit integer atomics. Integer sums do not depend on the order of
+// the additions, so the result is the same for any number of threads,
+// blocks or chunks. If offsets is NULL, weights holds one weight per event
+// of in; otherwise it holds one weight per jagged event.
+__global__ void histogram_gmem_weighted_fixed_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions,
+        const iType *offsets, const iType n_events, const fType *weights,
+        const double scale, unsigned long long int *out,
+        const iType *bins_in, const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped entries
+        if(current_bin >= 0)
+        {
+            unsigned int e = i/no_of_dimensions;
+            if(offsets != NULL) e = event_of_entry(offsets, n_events, e);
+            long long int fixed = llrint((double)weights[e] * scale);
+            atomicAdd(&out[current_bin], (unsigned long long int)fixed);
+        }
+    }
+}
+
+// Profile of the target y in the bins given by the edges: out holds three
+// arrays of no_of_flat_bins values, the sum of the weights, the weighted sum
+// of y - shift and the weighted sum of (y - shift)^2. Sums around a shift
+// close to the mean of y do not lose the variance to cancellation. weights
+// may be NULL for unit weights and events with a NaN target are skipped.
+// Other arguments as for histogram_gmem_weighted_with_edges.
+__global__ void histogram_profile_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions, const fType *y,
+        const fType *weights, const fType shift, const iType no_of_flat_bins,
+        fType *out, const iType *bins_in, const fType *edges_in,
+        const iType *guide_in, const iType *guide_info,
+        const fType *guide_scale, const long long int *int_range,
+        const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        unsigned int e = i/no_of_dimensions;
+        fType dy = y[e] - shift;
+        if(dy != dy) continue;
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        // Skip dropped events
+        if(current_bin >= 0)
+        {
+            fType w = (weights == NULL) ? 1 : weights[e];
+            atomicAddfType(&out[current_bin], w);
+            atomicAddfType(&out[no_of_flat_bins + current_bin], w*dy);
+            atomicAddfType(&out[2*no_of_flat_bins + current_bin], w*dy*dy);
+        }
+    }
+}
+
+// Mixing function of splitmix64; a bijection of 64 bit integers whose
+// outputs for consecutive inputs look independent.
+__device__ unsigned long long int mix64(unsigned long long int z)
+{
+    z += 0x9E3779B97F4A7C15ULL;
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+// Draws from Poisson(1) by inverting its CDF at the top 53 bits of the
+// random integer z. Only IEEE divisions and additions in double precision
+// are used, so the result is the same on every device.
+__device__ unsigned int poisson_one(const unsigned long long int z)
+{
+    double u = (z >> 11) * (1.0 / 9007199254740992.0);
+    double p = 0.36787944117144233;
+    double cdf = p;
+    unsigned int k = 0;
+    while(u >= cdf && k < 32)
+    {
+        k++;
+        p /= k;
+        cdf += p;
+    }
+    return k;
+}
+
+// Fills n_replicas bootstrap replicas of the histogram into out, one after
+// another. Each event is binned once and added to replica r with a Poisson(1)
+// weight drawn from a counter-based generator keyed by the seed, the index of
+// the event in the whole sample (first_event + index in this chunk) and r.
+// The weights and the integer sums therefore do not depend on the number of
+// threads, blocks or chunks. Other arguments as for
+// histogram_gmem_atomics_with_edges; out is a single histogram per replica.
+__global__ void histogram_bootstrap_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions,
+        const iType no_of_flat_bins, uiType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode,
+        const iType n_replicas, const unsigned long long int seed,
+        const unsigned long long int first_event)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, NULL);
+        // Skip dropped events
+        if(current_bin < 0) continue;
+        unsigned long long int key = mix64(seed
+            ^ mix64(first_event + i/no_of_dimensions));
+        for(unsigned int r = 0; r < n_replicas; r++)
+        {
+            unsigned int k = poisson_one(mix64(key + r));
+            if(k > 0)
             {
-                tmp_bin++;
+                atomicAdd(&out[r*no_of_flat_bins + current_bin], k);
             }
-            int power_bins = 1;
-            for(unsigned int k=no_of_dimensions-1; k > d; k--)
+        }
+    }
+}
+
+// Returns whether event e passes the packed bitmask mask. The bit order is
+// the one of numpy's packbits: event 0 is the most significant bit of the
+// first byte.
+__device__ bool is_selected(const unsigned char *mask, const unsigned int e)
+{
+    return (mask[e >> 3] >> (7 - (e & 7))) & 1;
+}
+
+// Like histogram_gmem_atomics_with_edges but fills one histogram for each of
+// n_selections packed bitmasks of mask_bytes bytes in masks. An event is
+// binned only if it passes any selection and is added to the histograms of
+// the selections it passes. Each partial histogram holds the histograms of
+// all selections one after another. first_event is the index of the first
+// event of in within the bitmasks, so the sample can be filled in chunks.
+__global__ void histogram_gmem_selected_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions,
+        const iType no_of_flat_bins, uiType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode,
+        const unsigned char *masks, const iType n_selections,
+        const iType mask_bytes, const iType first_event,
+        const iType n_copies)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    uiType *gmem = out
+        + n_selections * no_of_flat_bins * (blockIdx.x %% n_copies);
+    for(unsigned int i = gid * no_of_dimensions; i < length;
+            i += no_of_dimensions * total_threads)
+    {
+        unsigned int e = first_event + i/no_of_dimensions;
+        bool any_selected = false;
+        for(unsigned int s = 0; s < n_selections; s++)
+        {
+            if(is_selected(&masks[s*mask_bytes], e)) any_selected = true;
+        }
+        if(!any_selected) continue;
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, NULL);
+        // Skip dropped events
+        if(current_bin < 0) continue;
+        for(unsigned int s = 0; s < n_selections; s++)
+        {
+            if(is_selected(&masks[s*mask_bytes], e))
             {
-                power_bins = no_of_bins * power_bins;
+                atomicAdd(&gmem[s*no_of_flat_bins + current_bin], 1);
             }
-            current_bin += tmp_bin * power_bins;
         }
-        __syncthreads();
-        // Avoid illegal memory access
-        if(current_bin < no_of_flat_bins)
+    }
+}
+
+// Maximum number of distinct axes of histogram_multi_gmem_atomics
+#define MAX_AXES 64
+
+// Fills several histograms in one pass over the sample. An axis is a column
+// of the sample with its own edges; bins_in, edges_in, guide_in, guide_info,
+// guide_scale and int_range describe all axes as the dimensions of
+// find_flat_bin_with_edges. Each event is binned once per axis and the bins
+// are shared by all histograms using that axis.
+// spec_info holds for each histogram its number of axes, its weight column
+// (no_of_columns if it is unweighted), its offset in out (unweighted) or
+// weights_out (weighted) and its axes; spec_offsets holds where each
+// histogram starts in spec_info.
+__global__ void histogram_multi_gmem_atomics(const sType *in,
+        const iType length, const iType no_of_columns, const iType n_axes,
+        const iType *axis_column, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode,
+        const iType n_specs, const iType *spec_offsets,
+        const iType *spec_info, uiType *out, fType *weights_out)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    int axis_bins[MAX_AXES];
+    for(unsigned int i = gid*no_of_columns; i < length;
+        i+=no_of_columns*total_threads)
+    {
+        const fType *edges = edges_in;
+        bool has_nan = false;
+        bool has_inf = false;
+        for(unsigned int a = 0; a < n_axes; a++)
         {
-            atomicAdd(&smem[current_bin], 1);
+            const sType raw = in[i + axis_column[a]];
+            int tmp_bin;
+            bool val_is_inf = false;
+#ifdef SAMPLE_INTEGER
+            if(int_range[2*a] <= int_range[2*a+1])
+            {
+                tmp_bin = find_bin_integer(raw, int_range[2*a],
+                    int_range[2*a+1], bins_in[a]);
+            }
+            else
+#endif
+            {
+                fType val = __sample_as_fType(raw);
+                val_is_inf = isinf(val);
+                tmp_bin = find_bin(val, edges, bins_in[a],
+                    &guide_in[guide_info[a]], guide_info[n_axes+a],
+                    guide_scale[a]);
+            }
+            axis_bins[a] = apply_flow(tmp_bin, val_is_inf, a, n_axes,
+                bins_in[a], flow_mode, NULL, &has_nan, &has_inf);
+            edges += bins_in[a] + 1;
+        }
+        for(unsigned int s = 0; s < n_specs; s++)
+        {
+            const iType *info = &spec_info[spec_offsets[s]];
+            int current_bin = 0;
+            bool dropped = false;
+            for(unsigned int d = 0; d < info[0]; d++)
+            {
+                const iType a = info[3+d];
+                if(axis_bins[a] < 0) dropped = true;
+                current_bin = current_bin * bins_in[a] + axis_bins[a];
+            }
+            if(dropped) continue;
+            if(info[1] < no_of_columns)
+            {
+                atomicAddfType(&weights_out[info[2] + current_bin],
+                    __sample_as_fType(in[i + info[1]]));
+            }
+            else
+            {
+                atomicAdd(&out[info[2] + current_bin], 1);
+            }
         }
     }
-    __syncthreads();
+}
+
+// Write the flat bin of each event (or -1 if it is dropped) to bins_out
+// instead of filling a histogram. Used if not even a single histogram fits
+// into device memory. flow may be NULL; otherwise the counters described at
+// apply_flow are updated with atomics in global memory.
+__global__ void histogram_flat_bins(const sType *in, const iType length,
+        const iType no_of_dimensions, const iType no_of_bins, int *bins_out,
+        fType *max_in, fType *min_in, const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid*no_of_dimensions; i < length;
+        i+=no_of_dimensions*total_threads)
+    {
+        bins_out[i/no_of_dimensions] = find_flat_bin_uniform(&in[i],
+            no_of_dimensions, no_of_bins, max_in, min_in, flow_mode, flow);
+    }
+}
+
+__global__ void histogram_flat_bins_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions, int *bins_out,
+        const iType *bins_in, const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid*no_of_dimensions; i < length;
+        i+=no_of_dimensions*total_threads)
+    {
+        bins_out[i/no_of_dimensions] = find_flat_bin_with_edges(&in[i],
+            no_of_dimensions, bins_in, edges_in, guide_in, guide_info,
+            guide_scale, int_range, flow_mode, flow);
+    }
+}
 
-    // Write partial histograms in global memory
-    uiType *overall_out = &out[blockIdx.x * no_of_flat_bins];
-    for(unsigned int i = tid; i < no_of_flat_bins;  i+= threads_per_block)
+// Gathers the value of the bin of each event from values, an array with one
+// value per flat bin, into out. Events which are dropped get default_value.
+// Arguments as for histogram_flat_bins_with_edges; flow may be NULL.
+__global__ void histogram_lookup_with_edges(const sType *in,
+        const iType length, const iType no_of_dimensions, const fType *values,
+        const fType default_value, fType *out, const iType *bins_in,
+        const fType *edges_in, const iType *guide_in,
+        const iType *guide_info, const fType *guide_scale,
+        const long long int *int_range, const iType flow_mode, uiType *flow)
+{
+    unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
+    unsigned int total_threads = blockDim.x * gridDim.x;
+    for(unsigned int i = gid*no_of_dimensions; i < length;
+        i+=no_of_dimensions*total_threads)
     {
-        overall_out[i] = smem[i];
+        int current_bin = find_flat_bin_with_edges(&in[i], no_of_dimensions,
+            bins_in, edges_in, guide_in, guide_info, guide_scale, int_range,
+            flow_mode, flow);
+        out[i/no_of_dimensions] = (current_bin >= 0) ? values[current_bin]
+            : default_value;
     }
 }
 
@@ -348,7 +1017,10 @@ __global__ void histogram_final_accum(const uiType *in,
 {
     unsigned int gid = blockIdx.x * blockDim.x + threadIdx.x;
     unsigned int total_threads = blockDim.x * gridDim.x;
-    // Each thread merges values for another bin
+    // Each thread merges values for another bin. Integer sums do not depend
+    // on the order, and neighbouring threads read neighbouring bins of each
+    // copy, so a plain loop over the copies is as exact as a tree and reads
+    // memory coalesced.
     for(unsigned int current_bin = gid; current_bin < histo_length;
             current_bin += total_threads)
     {
@@ -0,0 +1,506 @@
+"""
+Local histogramming service.
+
+Every process which creates a `GPUHist` pays for compiling the kernels,
+querying the device and warming up its caches. `HistServer` does this once
+and fills histograms for any number of client processes on the same machine.
+
+Clients connect to a Unix socket and send one JSON request per line. Samples
+are not serialized: the client writes them into a shared memory segment (a
+file in `SHM_DIR`) and only sends its path, type and shape. The server maps
+the segment, fills the histogram and writes the result into a new segment
+which the client maps, copies and removes.
+
+Requests which arrive while the server is busy are batched: fills of the same
+sample segment with edges for each of its columns are done with a single
+`GPUHist.fill_many` pass, all others one after another.
+
+Command line usage::
+
+    python hist_server.py --socket /tmp/gpu_hist.sock
+
+"""
+
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    from collections.abc import Iterable
+    from queue import Queue, Empty
+except ImportError:
+    from collections import Iterable
+    from Queue import Queue, Empty
+
+import numpy as np
+
+
+__all__ = ['SHM_DIR', 'SharedArray', 'HistServer', 'HistClient']
+
+
+# Directory of the shared memory segments; /dev/shm is kept in memory
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Keyword arguments of `GPUHist.get_hist` which can be passed by clients
+GET_HIST_OPTIONS = ('shared', 'normed', 'density', 'out_of_range',
+                    'return_stats', 'memory_budget', 'auto_edges')
+
+
+class SharedArray(object):
+    """
+    Array in a shared memory segment which can be mapped by other processes
+    with its `info`.
+
+    Parameters
+    ----------
+    path : string
+    dtype : dtype
+    shape : tuple
+    mode : 'r', 'r+' or 'w+'
+        'w+' creates the segment
+
+    """
+    def __init__(self, path, dtype, shape, mode='r'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(int(n) for n in shape)
+        if int(np.prod(self.shape)) == 0:
+            # Empty files can not be mapped
+            self.array = np.zeros(self.shape, dtype=self.dtype)
+            if mode == 'w+':
+                open(path, 'wb').close()
+        else:
+            self.array = np.memmap(path, dtype=self.dtype, mode=mode,
+                                   shape=self.shape)
+
+    @classmethod
+    def create(cls, dtype, shape, prefix='gpu_hist_'):
+        """Create a new segment in `SHM_DIR`"""
+        path = os.path.join(SHM_DIR, prefix + uuid.uuid4().hex)
+        return cls(path, dtype, shape, mode='w+')
+
+    @classmethod
+    def from_array(cls, array, prefix='gpu_hist_'):
+        """Create a new segment holding a copy of `array`"""
+        array = np.asarray(array)
+        shared = cls.create(array.dtype, array.shape, prefix=prefix)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def from_info(cls, info, mode='r'):
+        return cls(info['path'], info['dtype'], info['shape'], mode=mode)
+
+    @property
+    def info(self):
+        """Description of the segment which can be sent as JSON"""
+        return {'path': self.path, 'dtype': self.dtype.str,
+                'shape': list(self.shape)}
+
+    def flush(self):
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+
+    def unlink(self):
+        """Remove the segment. Mapped arrays stay valid."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _send(sock_file, message):
+    sock_file.write((json.dumps(message) + '\n').encode('utf-8'))
+    sock_file.flush()
+
+
+def _receive(sock_file):
+    line = sock_file.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+
+def _edges_to_json(edges):
+    return [np.asarray(e, dtype=np.float64).tolist() for e in edges]
+
+
+def _is_edges(bins):
+    """Edges are sent as lists of lists, numbers of bins as int or list of
+    int"""
+    return isinstance(bins, list) and len(bins) > 0 and \
+        all(isinstance(e, list) for e in bins)
+
+
+def _bins_from_json(bins):
+    if _is_edges(bins):
+        return [np.asarray(e, dtype=np.float64) for e in bins]
+    return bins
+
+
+def _n_columns(info):
+    shape = info['shape']
+    return int(shape[1]) if len(shape) > 1 else 1
+
+
+def _default_engine(ftype):
+    import gpu_hist
+    return gpu_hist.GPUHist(ftype=ftype)
+
+
+class HistServer(object):
+    """
+    Serves histogram requests of local clients over a Unix socket.
+
+    Connections are handled by one thread each, but all histograms are
+    filled by the thread which runs `serve_forever`, since the CUDA context
+    belongs to it. Engines are created once per ftype and kept for the
+    lifetime of the server.
+
+    Parameters
+    ----------
+    socket_path : string
+    engine_factory : callable
+        Called with the ftype to create an engine with the interface of
+        `GPUHist`. Defaults to `GPUHist`.
+
+    """
+    def __init__(self, socket_path, engine_factory=_default_engine):
+        self.socket_path = socket_path
+        self.engine_factory = engine_factory
+        self.engines = {}
+        self.n_batches = 0
+        self._requests = Queue()
+        self._running = False
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(socket_path)
+        self._socket.listen(64)
+
+    def get_engine(self, ftype):
+        ftype = np.dtype(ftype).type
+        if ftype not in self.engines:
+            self.engines[ftype] = self.engine_factory(ftype)
+        return self.engines[ftype]
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._socket.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        """Pass the requests of one connection to the filling thread and
+        send back the replies"""
+        sock_file = conn.makefile('rwb')
+        try:
+            while True:
+                request = _receive(sock_file)
+                if request is None:
+                    break
+                done = threading.Event()
+                slot = {'request': request, 'done': done}
+                self._requests.put(slot)
+                done.wait()
+                _send(sock_file, slot['reply'])
+                if request.get('op') == 'shutdown':
+                    break
+        except (socket.error, IOError, ValueError):
+            pass
+        finally:
+            sock_file.close()
+            conn.close()
+
+    def serve_forever(self):
+        """Fill histograms until a client sends a shutdown request"""
+        self._running = True
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        try:
+            while self._running:
+                slots = [self._requests.get()]
+                # Batch all requests which arrived in the meantime
+                while True:
+                    try:
+                        slots.append(self._requests.get_nowait())
+                    except Empty:
+                        break
+                self._process(slots)
+        finally:
+            self.close()
+
+    def close(self):
+        self._running = False
+        self._socket.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _process(self, slots):
+        self.n_batches += 1
+        # Fills of the same sample with edges for each column share one pass
+        groups = {}
+        for slot in slots:
+            request = slot['request']
+            if request.get('op') == 'get_hist' and \
+                    set(request.get('options', {})) <= set(['out_of_range']) \
+                    and _is_edges(request.get('bins')) \
+                    and len(request['bins']) == _n_columns(request['sample']):
+                key = (request['sample']['path'], request.get('ftype'),
+                       request.get('options', {}).get('out_of_range', 'drop'))
+                groups.setdefault(key, []).append(slot)
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            try:
+                self._fill_many(group)
+            except Exception as error:
+                for slot in group:
+                    slot['reply'] = {'error': '%s: %s' % (
+                        type(error).__name__, error)}
+        for slot in slots:
+            if 'reply' not in slot:
+                try:
+                    slot['reply'] = self._reply(slot['request'])
+                except Exception as error:
+                    slot['reply'] = {'error': '%s: %s' % (
+                        type(error).__name__, error)}
+            slot['done'].set()
+
+    def _fill_many(self, group):
+        first = group[0]['request']
+        engine = self.get_engine(first.get('ftype', 'float64'))
+        sample = SharedArray.from_info(first['sample']).array
+        if sample.ndim == 1:
+            sample = sample[:, None]
+        # Plain (columns, edges) specs keep the GPU module out of the server
+        specs = []
+        for slot in group:
+            edges = _bins_from_json(slot['request']['bins'])
+            specs.append((list(range(len(edges))), edges))
+        results = engine.fill_many(
+            sample, specs,
+            out_of_range=first.get('options', {}).get('out_of_range', 'drop'))
+        for slot, (hist, edges) in zip(group, results):
+            slot['reply'] = self._result(hist, edges)
+
+    def _result(self, hist, edges, stats=None):
+        shared = SharedArray.from_array(hist, prefix='gpu_hist_result_')
+        shared.flush()
+        reply = {'hist': shared.info, 'edges': _edges_to_json(edges)}
+        if stats is not None:
+            reply['stats'] = dict(
+                (key, np.asarray(value).tolist())
+                for key, value in stats.items())
+        return reply
+
+    def _reply(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'batches': self.n_batches}
+        elif op == 'shutdown':
+            self._running = False
+            return {'ok': True}
+        elif op != 'get_hist':
+            raise ValueError('Unknown operation %s' % op)
+        options = request.get('options', {})
+        unknown = set(options) - set(GET_HIST_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown options %s' % sorted(unknown))
+        engine = self.get_engine(request.get('ftype', 'float64'))
+        sample = SharedArray.from_info(request['sample']).array
+        result = engine.get_hist(sample, bins=_bins_from_json(request['bins']),
+                                 **options)
+        return self._result(*result)
+
+
+class HistClient(object):
+    """
+    Client of a `HistServer`.
+
+    Parameters
+    ----------
+    socket_path : string
+
+    """
+    def __init__(self, socket_path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+
+    def _request(self, request):
+        _send(self._file, request)
+        reply = _receive(self._file)
+        if reply is None:
+            raise IOError('The server closed the connection')
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply
+
+    def ping(self):
+        return self._request({'op': 'ping'})
+
+    def shutdown(self):
+        """Stop the server"""
+        return self._request({'op': 'shutdown'})
+
+    def get_hist(self, sample, bins=10, ftype=np.float64, **options):
+        """Fill a histogram like `GPUHist.get_hist`; `options` are the
+        keyword arguments in `GET_HIST_OPTIONS`.
+
+        `sample` is either an array, which is copied into a shared memory
+        segment for this call, or a `SharedArray` which can be reused for
+        several calls without copying.
+        """
+        if isinstance(sample, SharedArray):
+            shared = sample
+        else:
+            shared = SharedArray.from_array(sample)
+            shared.flush()
+        if not isinstance(bins, Iterable):
+            bins = int(bins)
+        elif isinstance(bins[0], Iterable):
+            bins = _edges_to_json(bins)
+        else:
+            bins = [int(b) for b in bins]
+        try:
+            reply = self._request({
+                'op': 'get_hist', 'sample': shared.info, 'bins': bins,
+                'ftype': np.dtype(ftype).name, 'options': options})
+        finally:
+            if shared is not sample:
+                shared.unlink()
+        result = SharedArray.from_info(reply['hist'])
+        hist = np.array(result.array)
+        result.unlink()
+        edges = [np.asarray(e) for e in reply['edges']]
+        if 'stats' in reply:
+            stats = dict((key, np.asarray(value) if isinstance(value, list)
+                          else value) for key, value in reply['stats'].items())
+            return hist, edges, stats
+        return hist, edges
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def test_HistServer(n_events=1000):
+    """Serve clients on a local socket with an engine which fills with
+    numpy. The first request blocks the server until five others are queued,
+    so they arrive in one batch: two fills with edges share one `fill_many`
+    pass, while numbers of bins per dimension, edges for too few columns
+    and unknown options are handled one by one."""
+    class NumpyEngine(object):
+        def __init__(self):
+            self.n_fill_many = 0
+            self.blocked = False
+
+        def get_hist(self, sample, bins=10, **options):
+            if not self.blocked:
+                self.blocked = True
+                for i in range(1000):
+                    if server._requests.qsize() >= 5:
+                        break
+                    time.sleep(0.01)
+            hist, edges = np.histogramdd(sample, bins=bins)
+            return hist, edges
+
+        def fill_many(self, sample, specs, out_of_range='drop'):
+            self.n_fill_many += 1
+            return [np.histogramdd(sample[:, columns], bins=edges)
+                    for columns, edges in specs]
+
+    engine = NumpyEngine()
+    socket_path = os.path.join(tempfile.gettempdir(),
+                               'gpu_hist_test_%s.sock' % uuid.uuid4().hex)
+    server = HistServer(socket_path, engine_factory=lambda ftype: engine)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    rng = np.random.RandomState(0)
+    sample = SharedArray.from_array(rng.uniform(size=(n_events, 2)))
+    sample.flush()
+    edges = [np.linspace(0, 1, 5), np.linspace(0, 1, 3)]
+    calls = [
+        (0, {'bins': 10}),
+        (1, {'bins': edges}),
+        (2, {'bins': [e[::2] for e in edges]}),
+        (3, {'bins': [4, 6]}),
+        (4, {'bins': edges[:1]}),
+        (5, {'bins': edges, 'unknown': True}),
+    ]
+    results = {}
+
+    def call(index, kwargs):
+        with HistClient(socket_path) as client:
+            try:
+                results[index] = client.get_hist(sample, **kwargs)
+            except RuntimeError as error:
+                results[index] = error
+
+    try:
+        threads = []
+        for index, kwargs in calls:
+            thread = threading.Thread(target=call, args=(index, kwargs))
+            thread.start()
+            threads.append(thread)
+            if index == 0:
+                # The blocking request must be processed first
+                while not engine.blocked:
+                    time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        with HistClient(socket_path) as client:
+            # The blocking request, the batch of five and the ping
+            assert client.ping()['batches'] == 3
+            client.shutdown()
+        server_thread.join()
+    finally:
+        sample.unlink()
+
+    assert engine.n_fill_many == 1
+    for index, kwargs in calls[:4]:
+        hist, result_edges = results[index]
+        expected, expected_edges = np.histogramdd(sample.array,
+                                                  bins=kwargs['bins'])
+        assert np.array_equal(hist, expected)
+        for a, b in zip(result_edges, expected_edges):
+            assert np.allclose(a, b)
+    for index in (4, 5):
+        assert isinstance(results[index], RuntimeError)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+    description=
+            '''Histogramming service for local clients.''',
+    formatter_class=RawTextHelpFormatter)
+    parser.add_argument('--socket', type=str,
+            default=os.path.join(tempfile.gettempdir(), 'gpu_hist.sock'),
+            help=
+            '''Path of the Unix socket.''')
+    args = parser.parse_args()
+
+    server = HistServer(args.socket)
+    sys.stderr.write('Serving on %s\n' % args.socket)
+    server.serve_forever()
@@ -0,0 +1,592 @@
+"""
+Compact binary on-disk format for histograms.
+
+A histogram file consists of
+
+ * a fixed 64 byte header (see `HEADER_DTYPE`),
+ * the number of bins of each dimension (`n_dims` x uint64),
+ * the edges of all dimensions, concatenated (float64),
+ * one or more records, each holding an info block with the number of
+   nonzero bins of the record (uint64, since version 2), a count block and
+   optionally a sumw2 block (float64). Every block starts on an `ALIGNMENT`
+   byte boundary.
+
+Files are opened with mmap, so reading the counts or the edges does not copy
+any data. Partial results of batch jobs can be appended as additional records
+and `merge_files` streams any number of files into a single total while only
+holding `block_bins` bins in memory at a time.
+
+Command line usage::
+
+    python hist_store.py merge -o total.hist part_*.hist
+    python hist_store.py info total.hist
+
+"""
+
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+import mmap
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+
+import numpy as np
+
+
+__all__ = ['MAGIC', 'VERSION', 'ALIGNMENT', 'HEADER_DTYPE', 'HistFile',
+           'save_hist', 'open_hist', 'load_hist', 'merge_files',
+           'reduce_partials']
+
+
+MAGIC = b'\x93GPUHIST'
+VERSION = 2
+ALIGNMENT = 64
+# Bytes of partial histograms reduced at once by each thread of
+# `reduce_partials`; should fit into the cache of one core
+REDUCE_BLOCK_BYTES = 1 << 20
+
+# Flags stored in the header
+FLAG_SUMW2 = 1
+# Records start with an info block (files of version 2)
+FLAG_RECORD_INFO = 2
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('n_dims', '<u4'),
+    ('count_dtype', 'S8'),
+    ('flags', '<u4'),
+    ('n_records', '<u4'),
+    ('n_partials', '<u8'),
+    ('data_offset', '<u8'),
+    ('record_bytes', '<u8'),
+    ('reserved', '<u8'),
+])
+assert HEADER_DTYPE.itemsize == 64
+
+EDGE_DTYPE = np.dtype('<f8')
+SUMW2_DTYPE = np.dtype('<f8')
+
+
+def _align(n_bytes):
+    return (n_bytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _widen(dtype):
+    """Accumulator type used when merging many records of type `dtype`"""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        return np.dtype('<u8')
+    elif dtype.kind in 'ib':
+        return np.dtype('<i8')
+    return np.dtype('<f8')
+
+
+def _layout(shape, count_dtype, has_sumw2):
+    """Return (data_offset, count_bytes, record_bytes) for a histogram.
+    Each record starts with an info block of `ALIGNMENT` bytes."""
+    n_dims = len(shape)
+    n_flat_bins = int(np.prod(shape, dtype=np.int64))
+    n_edges = sum(shape) + n_dims
+    data_offset = _align(HEADER_DTYPE.itemsize + 8*n_dims
+                         + EDGE_DTYPE.itemsize*n_edges)
+    count_bytes = _align(n_flat_bins * np.dtype(count_dtype).itemsize)
+    record_bytes = ALIGNMENT + count_bytes
+    if has_sumw2:
+        record_bytes += _align(n_flat_bins * SUMW2_DTYPE.itemsize)
+    return data_offset, count_bytes, record_bytes
+
+
+def reduce_partials(partials, out, block_bins=None, n_threads=None,
+                    touched=None):
+    """Add partial histograms to `out`.
+
+    The bins are split into blocks which are reduced independently on
+    `n_threads` threads, so the block of `out` stays in cache while the
+    partials stream through it. Float partials are summed pairwise in a tree
+    within each block, so rounding errors grow only logarithmically with the
+    number of partials; integers are added one after another.
+
+    Parameters
+    ----------
+    partials : array of shape (n_partials, n_bins)
+        May be a strided view, e.g. the records of a `HistFile`
+    out : array of shape (n_bins,)
+        Accumulator; should be wide enough for the sum
+    block_bins : None or int
+        Upper limit for the number of bins per block. By default a block
+        takes about `REDUCE_BLOCK_BYTES`.
+    n_threads : None or int
+        Defaults to the number of CPUs
+    touched : None or sequence of bool
+        Which partials have any entries; the others are skipped without
+        being read. By default all partials are added.
+
+    """
+    n_partials, n_bins = partials.shape
+    # Rows of the partials which are added; None for all of them
+    index = None
+    if touched is not None:
+        index = np.flatnonzero(touched)
+        if len(index) == n_partials:
+            index = None
+        else:
+            n_partials = len(index)
+    if n_partials == 0 or n_bins == 0:
+        return out
+    tree = np.dtype(out.dtype).kind == 'f' and n_partials > 2
+    itemsize = np.dtype(out.dtype).itemsize
+    # The tree needs a scratch block for half of the partials
+    cache_bins = REDUCE_BLOCK_BYTES // itemsize
+    if tree:
+        cache_bins //= (n_partials + 1) // 2 + 1
+    cache_bins = max(cache_bins, ALIGNMENT)
+    if block_bins is None:
+        block_bins = cache_bins
+    block_bins = max(min(block_bins, cache_bins), 1)
+    if n_threads is None:
+        n_threads = cpu_count()
+
+    def reduce_block(start):
+        stop = min(start + block_bins, n_bins)
+        block = partials[:, start:stop]
+        if index is None:
+            rows_in = block
+        else:
+            # Skipped rows are never touched, so views of mapped files are
+            # not copied
+            rows_in = [block[i] for i in index]
+        if not tree:
+            acc = out[start:stop]
+            for row in rows_in:
+                # The accumulator may be narrower if the caller chose so
+                np.add(acc, row, out=acc, casting='unsafe')
+            return
+        # The first level of the tree reads the partials and fills the
+        # scratch block
+        n_pairs = n_partials // 2
+        rows = np.empty((n_pairs + n_partials % 2, stop - start),
+                        dtype=out.dtype)
+        if index is None:
+            np.add(block[0:2*n_pairs:2], block[1:2*n_pairs:2],
+                   out=rows[:n_pairs], casting='unsafe')
+        else:
+            for j in range(n_pairs):
+                np.add(rows_in[2*j], rows_in[2*j+1], out=rows[j],
+                       casting='unsafe')
+        if n_partials % 2:
+            rows[n_pairs] = rows_in[-1]
+        n_rows = len(rows)
+        step = 1
+        while step < n_rows:
+            rows[0:n_rows-step:2*step] += rows[step:n_rows:2*step]
+            step *= 2
+        out[start:stop] += rows[0]
+
+    starts = range(0, n_bins, block_bins)
+    n_threads = min(n_threads, len(starts))
+    if n_threads > 1:
+        # numpy releases the GIL while adding the blocks
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(reduce_block, starts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for start in starts:
+            reduce_block(start)
+    return out
+
+
+def _pad(fobj, n_bytes):
+    if n_bytes > 0:
+        fobj.write(b'\x00' * n_bytes)
+
+
+def _write_info(fobj, hist, sumw2):
+    # The number of nonzero bins lets merges skip empty records
+    nonzero = np.count_nonzero(hist)
+    if sumw2 is not None:
+        nonzero = max(nonzero, np.count_nonzero(sumw2))
+    np.array([nonzero], dtype='<u8').tofile(fobj)
+    _pad(fobj, ALIGNMENT - 8)
+
+
+def _write_record(fobj, hist, sumw2, count_bytes, info=True):
+    if info:
+        _write_info(fobj, hist, sumw2)
+    hist.tofile(fobj)
+    _pad(fobj, count_bytes - hist.nbytes)
+    if sumw2 is not None:
+        sumw2.tofile(fobj)
+        _pad(fobj, _align(sumw2.nbytes) - sumw2.nbytes)
+
+
+def save_hist(path, hist, edges, sumw2=None, n_partials=1):
+    """Write a histogram to `path`, overwriting an existing file.
+
+    Parameters
+    ----------
+    path : string
+    hist : array
+        Counts (or sum of weights) as returned by `GPUHist.get_hist`
+    edges : sequence of arrays
+        Edges for each dimension, including the rightmost edge
+    sumw2 : None or array
+        Sum of squared weights with the same shape as `hist`
+    n_partials : int
+        Number of partial results this histogram was built from
+
+    """
+    hist = np.asarray(hist)
+    count_dtype = hist.dtype.newbyteorder('<')
+    hist = np.ascontiguousarray(hist, dtype=count_dtype)
+    shape = hist.shape
+    edges = [np.asarray(e, dtype=EDGE_DTYPE).ravel() for e in edges]
+    if len(edges) != len(shape):
+        raise ValueError('Got %d edge arrays for a %d-dimensional histogram'
+                         % (len(edges), len(shape)))
+    for d, e in enumerate(edges):
+        if len(e) != shape[d] + 1:
+            raise ValueError('Dimension %d has %d bins but %d edges'
+                             % (d, shape[d], len(e)))
+    if sumw2 is not None:
+        sumw2 = np.ascontiguousarray(sumw2, dtype=SUMW2_DTYPE)
+        if sumw2.shape != shape:
+            raise ValueError('`sumw2` must have the same shape as `hist`')
+
+    data_offset, count_bytes, record_bytes = _layout(
+        shape, count_dtype, sumw2 is not None)
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['n_dims'] = len(shape)
+    header['count_dtype'] = count_dtype.str.encode('ascii')
+    header['flags'] = FLAG_RECORD_INFO | (
+        FLAG_SUMW2 if sumw2 is not None else 0)
+    header['n_records'] = 1
+    header['n_partials'] = n_partials
+    header['data_offset'] = data_offset
+    header['record_bytes'] = record_bytes
+
+    with open(path, 'wb') as fobj:
+        header.tofile(fobj)
+        np.asarray(shape, dtype='<u8').tofile(fobj)
+        for e in edges:
+            e.tofile(fobj)
+        _pad(fobj, data_offset - fobj.tell())
+        _write_record(fobj, hist, sumw2, count_bytes)
+
+
+class HistFile(object):
+    """
+    Memory-mapped view of a histogram file written by `save_hist`.
+
+    All arrays handed out by this class are views into the mapped file; no
+    data is copied until it is actually used. Views keep the mapping alive,
+    even after the file is closed.
+
+    Parameters
+    ----------
+    path : string
+    mode : 'r' or 'r+'
+        Use 'r+' to append records.
+
+    """
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'r+'):
+            raise ValueError("`mode` must be 'r' or 'r+'. Got %s instead."
+                             % mode)
+        self.path = path
+        self.mode = mode
+        self._fobj = open(path, mode + 'b')
+        self._mmap = None
+        self._map()
+
+    def _map(self):
+        access = mmap.ACCESS_READ if self.mode == 'r' else mmap.ACCESS_WRITE
+        self._mmap = mmap.mmap(self._fobj.fileno(), 0, access=access)
+        header = np.ndarray(1, dtype=HEADER_DTYPE, buffer=self._mmap).copy()
+        if header['magic'][0] != MAGIC:
+            self.close()
+            raise IOError('"%s" is not a histogram file' % self.path)
+        if header['version'][0] > VERSION:
+            self.close()
+            raise IOError('"%s" has unsupported version %d'
+                          % (self.path, header['version'][0]))
+        self.header = header
+        n_dims = int(self.header['n_dims'][0])
+        self.shape = tuple(int(s) for s in np.ndarray(
+            n_dims, dtype='<u8', buffer=self._mmap,
+            offset=HEADER_DTYPE.itemsize))
+        self.n_flat_bins = int(np.prod(self.shape, dtype=np.int64))
+        self.count_dtype = np.dtype(
+            self.header['count_dtype'][0].decode('ascii'))
+        self.has_sumw2 = bool(self.header['flags'][0] & FLAG_SUMW2)
+        # Records of version 1 files have no info block
+        self.info_bytes = ALIGNMENT \
+            if self.header['flags'][0] & FLAG_RECORD_INFO else 0
+
+        offset = HEADER_DTYPE.itemsize + 8*n_dims
+        self.edges = []
+        for n_bins in self.shape:
+            self.edges.append(np.ndarray(n_bins+1, dtype=EDGE_DTYPE,
+                                         buffer=self._mmap, offset=offset))
+            offset += EDGE_DTYPE.itemsize * (n_bins+1)
+
+        self.data_offset = int(self.header['data_offset'][0])
+        self.record_bytes = int(self.header['record_bytes'][0])
+        self.count_bytes = _align(self.n_flat_bins * self.count_dtype.itemsize)
+        self.n_records = int(self.header['n_records'][0])
+        self.n_partials = int(self.header['n_partials'][0])
+
+    def _records(self, offset, dtype):
+        return np.ndarray(
+            (self.n_records, self.n_flat_bins), dtype=dtype,
+            buffer=self._mmap, offset=self.data_offset + offset,
+            strides=(self.record_bytes, dtype.itemsize)
+        )
+
+    @property
+    def records(self):
+        """Counts of all records, shape (n_records, n_flat_bins)"""
+        return self._records(self.info_bytes, self.count_dtype)
+
+    @property
+    def sumw2_records(self):
+        """Sum of squared weights of all records or None"""
+        if not self.has_sumw2:
+            return None
+        return self._records(self.info_bytes + self.count_bytes, SUMW2_DTYPE)
+
+    @property
+    def nonzero(self):
+        """Number of nonzero bins of each record or None for files without
+        record infos"""
+        if not self.info_bytes:
+            return None
+        return np.ndarray(self.n_records, dtype='<u8', buffer=self._mmap,
+                          offset=self.data_offset,
+                          strides=(self.record_bytes,))
+
+    @property
+    def hist(self):
+        """Counts with the histogram shape. Only zero-copy for files with a
+        single record; otherwise all records are summed up."""
+        if self.n_records == 1:
+            return self.records[0].reshape(self.shape)
+        return self.total()[0]
+
+    @property
+    def sumw2(self):
+        if not self.has_sumw2:
+            return None
+        if self.n_records == 1:
+            return self.sumw2_records[0].reshape(self.shape)
+        return self.total()[1]
+
+    def total(self, block_bins=1<<20):
+        """Sum of all records as (hist, sumw2) in memory. The records are
+        reduced block by block to stay cache friendly."""
+        dtype = _widen(self.count_dtype)
+        hist = np.zeros(self.n_flat_bins, dtype=dtype)
+        sumw2 = np.zeros(self.n_flat_bins, dtype=SUMW2_DTYPE) \
+            if self.has_sumw2 else None
+        self.accumulate_into(hist, sumw2, block_bins=block_bins)
+        if sumw2 is not None:
+            sumw2 = sumw2.reshape(self.shape)
+        return hist.reshape(self.shape), sumw2
+
+    def accumulate_into(self, hist, sumw2=None, block_bins=1<<20,
+                        n_threads=None):
+        """Add all records to the flat arrays `hist` and `sumw2` with
+        `reduce_partials`. Records without nonzero bins are skipped."""
+        touched = None
+        if self.nonzero is not None:
+            touched = self.nonzero > 0
+        reduce_partials(self.records, hist, block_bins=block_bins,
+                        n_threads=n_threads, touched=touched)
+        if sumw2 is not None and self.has_sumw2:
+            reduce_partials(self.sumw2_records, sumw2, block_bins=block_bins,
+                            n_threads=n_threads, touched=touched)
+
+    def append(self, hist, sumw2=None, n_partials=1):
+        """Append a partial result as a new record. The histogram must have
+        the same shape as the stored one; the edges are not checked."""
+        if self.mode != 'r+':
+            raise IOError('"%s" is not opened for appending' % self.path)
+        hist = np.ascontiguousarray(hist, dtype=self.count_dtype)
+        if hist.size != self.n_flat_bins:
+            raise ValueError('Expected %d bins, got %d'
+                             % (self.n_flat_bins, hist.size))
+        if self.has_sumw2:
+            if sumw2 is None:
+                sumw2 = np.zeros(self.n_flat_bins, dtype=SUMW2_DTYPE)
+            sumw2 = np.ascontiguousarray(sumw2, dtype=SUMW2_DTYPE)
+        else:
+            sumw2 = None
+
+        # Views handed out before stay valid since the file only grows.
+        self._fobj.seek(self.data_offset + self.n_records*self.record_bytes)
+        _write_record(self._fobj, hist, sumw2, self.count_bytes,
+                      info=bool(self.info_bytes))
+        self._update_header(n_records=self.n_records + 1,
+                            n_partials=self.n_partials + n_partials)
+
+    def _update_header(self, **fields):
+        header = self.header.copy()
+        for key, value in fields.items():
+            header[key] = value
+        self._fobj.seek(0)
+        header.tofile(self._fobj)
+        self._fobj.flush()
+        self._map()
+
+    def flush(self):
+        if self._mmap is not None and self.mode == 'r+':
+            self._mmap.flush()
+
+    def close(self):
+        # The mapping itself is released once no view into it is left.
+        self._mmap = None
+        if self._fobj is not None:
+            self._fobj.close()
+            self._fobj = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_hist(path, mode='r'):
+    """Open a histogram file; see `HistFile`"""
+    return HistFile(path, mode=mode)
+
+
+def load_hist(path):
+    """Read a histogram file into memory.
+
+    Returns
+    -------
+    hist, edges, sumw2 (None if the file has no sumw2 block)
+
+    """
+    with HistFile(path) as hfile:
+        if hfile.n_records == 1:
+            hist = np.array(hfile.hist)
+            sumw2 = None if not hfile.has_sumw2 else np.array(hfile.sumw2)
+        else:
+            hist, sumw2 = hfile.total()
+        edges = [np.array(e) for e in hfile.edges]
+    return hist, edges, sumw2
+
+
+def merge_files(paths, out_path, block_bins=1<<20, count_dtype=None,
+                check_edges=True):
+    """Sum the histograms of many files into one file.
+
+    Files are processed one after another and each is reduced into the
+    memory-mapped output in blocks of `block_bins` bins, so memory use does
+    not depend on the number of files and only one input file is open at a
+    time. Either all files or none of them must hold sumw2.
+
+    Parameters
+    ----------
+    paths : sequence of strings
+    out_path : string
+    block_bins : int
+        Number of bins merged at once
+    count_dtype : None or dtype
+        Type of the merged counts; defaults to a 64 bit type which can hold
+        the counts of all files (e.g. float64 if any file holds floats) to
+        avoid overflows.
+    check_edges : bool
+        Verify that all files share the edges of the first one
+
+    """
+    paths = list(paths)
+    if len(paths) == 0:
+        raise ValueError('No files to merge')
+
+    with HistFile(paths[0]) as first:
+        edges = [np.array(e) for e in first.edges]
+        shape = first.shape
+        has_sumw2 = first.has_sumw2
+    # Only the headers are read to find a type for all files
+    dtypes = []
+    for path in paths:
+        with HistFile(path) as hfile:
+            dtypes.append(hfile.count_dtype)
+            if hfile.has_sumw2 != has_sumw2:
+                raise ValueError('Either all or none of the files must have '
+                                 'sumw2, but only one of "%s" and "%s" has'
+                                 % (paths[0], path))
+    if count_dtype is None:
+        count_dtype = _widen(np.result_type(*dtypes))
+    save_hist(out_path, np.zeros(shape, dtype=count_dtype), edges,
+              sumw2=np.zeros(shape) if has_sumw2 else None, n_partials=0)
+
+    n_partials = 0
+    with HistFile(out_path, mode='r+') as out:
+        total = out.records[0]
+        total_sumw2 = out.sumw2_records[0] if has_sumw2 else None
+        for path in paths:
+            with HistFile(path) as hfile:
+                if hfile.shape != shape:
+                    raise ValueError('"%s" has shape %s, expected %s'
+                                     % (path, hfile.shape, shape))
+                if check_edges and not all(
+                        np.array_equal(a, b)
+                        for a, b in zip(hfile.edges, edges)):
+                    raise ValueError('"%s" has different edges' % path)
+                hfile.accumulate_into(total, total_sumw2,
+                                      block_bins=block_bins)
+                n_partials += hfile.n_partials
+        nonzero = np.count_nonzero(total)
+        if total_sumw2 is not None:
+            nonzero = max(nonzero, np.count_nonzero(total_sumw2))
+        out.nonzero[0] = nonzero
+        del total, total_sumw2
+        out.flush()
+        out._update_header(n_partials=n_partials)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(
+    description=
+            '''Inspect and merge histogram files.''',
+    formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    merge_parser = subparsers.add_parser('merge',
+            help=
+            '''Sum all input files into one output file.''')
+    merge_parser.add_argument('-o', '--output', type=str, required=True,
+            help=
+            '''Output file. It will be overwritten if it exists.''')
+    merge_parser.add_argument('--block-bins', type=int, default=1<<20,
+            help=
+            '''Number of bins merged at once. Limits the memory usage.''')
+    merge_parser.add_argument('inputs', nargs='+',
+            help=
+            '''Histogram files to merge.''')
+    info_parser = subparsers.add_parser('info',
+            help=
+            '''Print the header of histogram files.''')
+    info_parser.add_argument('inputs', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        merge_files(args.inputs, args.output, block_bins=args.block_bins)
+    elif args.command == 'info':
+        for path in args.inputs:
+            with HistFile(path) as hfile:
+                sys.stdout.write(
+                    '%s: shape=%s, dtype=%s, sumw2=%s, records=%d, '
+                    'partials=%d, size=%d bytes\n'
+                    % (path, hfile.shape, hfile.count_dtype, hfile.has_sumw2,
+                       hfile.n_records, hfile.n_partials,
+                       os.path.getsize(path)))
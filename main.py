@@ -480,18 +480,10 @@ if __name__ == '__main__':
         edges = args.bins
 
     if args.test:
-        mem = virtual_memory()
-        available_memory = mem.available
-        amount_of_elements = [1e8] #, 1e3, 1e4]
-
-        # TODO: What is going on here? I suppose this kind of logic could be
-        # used to limit the below-defined "all_bins" and "all_elements"
-        # appropriately, but... not really clear how exactly to do so, and
-        # probably depends upon ftype, etc. to do this correctly.
-        max_elements = 0
-        for i in amount_of_elements:
-            if available_memory > i*8:
-                max_elements = max_elements+1
+        # The GPU histograms plan their device memory themselves (see
+        # `GPUHist.plan_memory`), so only skip configurations whose sample
+        # and numpy histogram do not fit into host memory.
+        available_memory = virtual_memory().available
 
         n_trials = 10
         timings = []
@@ -505,6 +497,12 @@ if __name__ == '__main__':
                 all_dims, all_elements, all_bins, all_ftypes):
             n_elements = int(n_elements)
             n_bins = int(n_bins)
+            host_bytes = (n_elements*n_dims*np.dtype(ftype).itemsize
+                          + n_bins**n_dims*8)
+            if host_bytes > available_memory:
+                print("Skipping %d elements and %d bins: not enough host "
+                      "memory" % (n_elements, n_bins))
+                continue
 
             info = OrderedDict([
                 ('ftype', ftype.__name__),